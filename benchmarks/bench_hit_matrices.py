@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from hit_encoding import convert_to_hit_matrices
+from ragged import HIT_PADDING
+
+# CONSTANTS
+MAX_DETECTOR_ID = 62
+MAX_ELEMENT_ID = 384
+HITS_PER_EVENT = 72
+HIT_SLOTS = 500
+
+# Fixed-width padded hit arrays shaped like the detectorID/elementID branches in runs/
+def make_events(num_events, seed=0):
+    rng = np.random.default_rng(seed)
+    detector_ids = np.full((num_events, HIT_SLOTS), HIT_PADDING, dtype=np.int32)
+    element_ids = np.full((num_events, HIT_SLOTS), HIT_PADDING, dtype=np.int32)
+    detector_ids[:, :HITS_PER_EVENT] = rng.integers(1, MAX_DETECTOR_ID + 1, (num_events, HITS_PER_EVENT))
+    element_ids[:, :HITS_PER_EVENT] = rng.integers(1, MAX_ELEMENT_ID + 1, (num_events, HITS_PER_EVENT))
+
+    return detector_ids, element_ids
+
+# The per-event loop convert_to_hit_matrices used to run, including the np.where filtering
+def legacy_convert_to_hit_matrices(detector_events, element_events, max_detector_id, max_element_id):
+    detector_events = np.where(detector_events <= max_detector_id, detector_events, 0)
+    element_events = np.where(element_events <= max_element_id, element_events, 0)
+
+    num_events = detector_events.shape[0]
+    hit_matrices = np.zeros((num_events, max_detector_id, max_element_id), dtype=int)
+    for event_idx in range(num_events):
+        detectors = detector_events[event_idx] - 1
+        elements = element_events[event_idx] - 1
+        hit_matrices[event_idx, detectors, elements] = 1
+
+    return hit_matrices
+
+def time_call(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+if __name__ == "__main__":
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    detector_ids, element_ids = make_events(num_events)
+
+    legacy_time, legacy = time_call(legacy_convert_to_hit_matrices, detector_ids, element_ids, MAX_DETECTOR_ID, MAX_ELEMENT_ID)
+    vectorized_time, vectorized = time_call(convert_to_hit_matrices, detector_ids, element_ids, MAX_DETECTOR_ID, MAX_ELEMENT_ID)
+
+    # the legacy loop maps padding to index -1 and marks the last channel; the new encoder drops it
+    legacy[:, -1, -1] = vectorized[:, -1, -1]
+    if not np.array_equal(legacy, vectorized):
+        raise Exception("Vectorized hit matrices don't match the legacy loop.")
+
+    print("{} events".format(num_events))
+    print("legacy:     {:8.3f} s  {:8.1f} MB".format(legacy_time, legacy.nbytes / 1e6))
+    print("vectorized: {:8.3f} s  {:8.1f} MB".format(vectorized_time, vectorized.nbytes / 1e6))
+    print("speedup:    {:8.1f}x".format(legacy_time / vectorized_time))
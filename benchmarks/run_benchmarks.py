@@ -0,0 +1,384 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import numpy as np
+
+# CPU only, and quiet TensorFlow
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCHMARK_DIR, "..")
+sys.path.insert(0, REPO_DIR)
+from file_read import get_detector_info, read_events
+from synthetic_events import SPECTROMETER_INFO_PATH, make_hits, make_momenta, write_root_file
+
+# CONSTANTS
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}
+RESULTS_DIR = os.path.join(BENCHMARK_DIR, "results")
+DEFAULT_REPEAT = 3
+RSS_SAMPLE_INTERVAL = 0.002  # seconds between resident memory samples
+HIT_MATRIX_CHUNK = 4096  # events encoded per convert_to_hit_matrices call, into one reused buffer
+TRACK_IMAGE_IDS = 100  # hit image size of track_momentum_model (its MAX_IDS)
+
+# name -> (setup function, most events the benchmark runs on). A setup function takes the
+# BenchmarkData and a number of events, does any untimed preparation and returns the
+# zero-argument callable that is timed. Stages that are too slow or too memory hungry to
+# run on every event of the larger scales are capped; results record the events used.
+BENCHMARKS = dict()
+
+def benchmark(name, max_events=None):
+    def register(setup):
+        BENCHMARKS[name] = (setup, max_events)
+        return setup
+    return register
+
+# Synthetic inputs for one scale, each generated on first use and shared by the benchmarks
+class BenchmarkData:
+    def __init__(self, num_events, work_dir, seed=0):
+        self.num_events = num_events
+        self.work_dir = work_dir
+        self.seed = seed
+        self.name_to_id_elements = get_detector_info(SPECTROMETER_INFO_PATH)
+        self.max_detector_id = max(detector_id for detector_id, _, _ in self.name_to_id_elements.values())
+        self.max_element_id = max(num_elements for _, num_elements, _ in self.name_to_id_elements.values())
+        self._hits = None
+        self._momenta = None
+
+    def hits(self, num_events):
+        if self._hits is None:
+            self._hits = make_hits(self.num_events, seed=self.seed)
+        return self._hits[0][:num_events], self._hits[1][:num_events]
+
+    def momenta(self, num_events):
+        if self._momenta is None:
+            self._momenta = make_momenta(self.num_events, seed=self.seed)
+        return [values[:num_events] for values in self._momenta]
+
+    # ROOT file holding the first num_events events, laid out like runs/trackQA*.root, written
+    # once per scale and shared by the benchmark processes
+    def root_file(self, num_events):
+        file_path = os.path.join(self.work_dir, "synthetic_{}.root".format(num_events))
+        if not os.path.exists(file_path):
+            write_root_file(file_path + ".tmp", *self.hits(num_events), self.momenta(num_events))
+            os.replace(file_path + ".tmp", file_path)
+        return file_path
+
+# Peak resident memory of the process above its level at the start, sampled from
+# /proc/self/statm in a background thread while the block runs
+class PeakMemory:
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.page_size = os.sysconf("SC_PAGE_SIZE")
+        self.peak = 0
+
+    def rss(self):
+        with open("/proc/self/statm", "r") as infile:
+            return int(infile.read().split()[1]) * self.page_size
+
+    def _sample(self):
+        while not self._done.is_set():
+            self.peak = max(self.peak, self.rss())
+            self._done.wait(self.interval)
+
+    def __enter__(self):
+        self.start = self.peak = self.rss()
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.rss())
+
+    @property
+    def increase_mb(self):
+        return (self.peak - self.start) / 1e6
+
+# Run a callable that asks for a tree/branch choice on stdin, answering the first option
+def answer_prompts(function, *args):
+    stdin = sys.stdin
+    sys.stdin = io.StringIO("1\n" * 10)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function(*args)
+    finally:
+        sys.stdin = stdin
+
+@benchmark("read_events", max_events=100000)
+def bench_read_events(data, num_events):
+    file_path = data.root_file(num_events)
+    return lambda: answer_prompts(read_events, file_path)
+
+@benchmark("read_events_cache_build", max_events=100000)
+def bench_read_events_cache_build(data, num_events):
+    file_path = data.root_file(num_events)
+    cache_dir = os.path.join(data.work_dir, "event_cache")
+
+    def run():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        detector_events, element_events = answer_prompts(read_events, file_path, cache_dir)
+        return detector_events.flat().sum() + element_events.flat().sum()
+    return run
+
+@benchmark("read_events_cache_warm", max_events=100000)
+def bench_read_events_cache_warm(data, num_events):
+    file_path = data.root_file(num_events)
+    cache_dir = os.path.join(data.work_dir, "event_cache")
+    answer_prompts(read_events, file_path, cache_dir)
+
+    def run():
+        detector_events, element_events = read_events(file_path, cache_dir)
+        return detector_events.flat().sum() + element_events.flat().sum()
+    return run
+
+@benchmark("convert_to_hit_matrices")
+def bench_convert_to_hit_matrices(data, num_events):
+    from hit_encoding import convert_to_hit_matrices
+
+    detector_events, element_events = data.hits(num_events)
+
+    def run():
+        buffer = np.zeros((HIT_MATRIX_CHUNK, data.max_detector_id, data.max_element_id), dtype=np.uint8)
+        for start in range(0, num_events, HIT_MATRIX_CHUNK):
+            stop = min(start + HIT_MATRIX_CHUNK, num_events)
+            convert_to_hit_matrices(detector_events[start:stop], element_events[start:stop], data.max_detector_id,
+                                    data.max_element_id, out=buffer[:stop - start])
+    return run
+
+@benchmark("join_momentum_arrays")
+def bench_join_momentum_arrays(data, num_events):
+    from labels import join_momentum_arrays
+
+    gpx, gpy, gpz = data.momenta(num_events)
+    return lambda: join_momentum_arrays(gpx, gpy, gpz)
+
+@benchmark("create_detector_heatmaps", max_events=10)
+def bench_create_detector_heatmaps(data, num_events):
+    from plot import create_detector_heatmaps
+
+    detector_events, element_events = data.hits(num_events)
+
+    def run():
+        for event in range(num_events):
+            create_detector_heatmaps(detector_events[event], element_events[event], data.name_to_id_elements, data.max_element_id, [])
+    return run
+
+@benchmark("predict_trackwise_data", max_events=5000)
+def bench_predict_trackwise_data(data, num_events):
+    from track_momentum_model import build_track_segmentation_model, predict_trackwise_data
+
+    detector_events, element_events = data.hits(num_events)
+    n_tracks = np.full(num_events, 2)
+    model = build_track_segmentation_model((TRACK_IMAGE_IDS, TRACK_IMAGE_IDS, 1))
+    predict_trackwise_data(detector_events[:1], element_events[:1], n_tracks[:1], TRACK_IMAGE_IDS, model)
+    return lambda: predict_trackwise_data(detector_events, element_events, n_tracks, TRACK_IMAGE_IDS, model)
+
+@benchmark("create_video", max_events=100)
+def bench_create_video(data, num_events):
+    from plot import create_video
+
+    detector_events, element_events = data.hits(num_events)
+    video_name = os.path.join(data.work_dir, "benchmark.avi")
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            create_video(detector_events, element_events, data.name_to_id_elements, data.max_element_id, 0, [], video_name)
+    return run
+
+@benchmark("cluster_hits", max_events=100000)
+def bench_cluster_hits(data, num_events):
+    from clustering import cluster_hits
+
+    detector_events, element_events = data.hits(num_events)
+    return lambda: cluster_hits(detector_events, element_events)
+
+@benchmark("fit_events", max_events=100000)
+def bench_fit_events(data, num_events):
+    from geometry import load_geometry
+    from track_fit import fit_events
+
+    detector_events, element_events = data.hits(num_events)
+    geometry = load_geometry(SPECTROMETER_INFO_PATH, os.path.join(data.work_dir, "geometry_cache"))
+    return lambda: fit_events(detector_events, element_events, geometry=geometry)
+
+@benchmark("find_tracks", max_events=20000)
+def bench_find_tracks(data, num_events):
+    from geometry import load_geometry
+    from hough import find_tracks
+
+    detector_events, element_events = data.hits(num_events)
+    geometry = load_geometry(SPECTROMETER_INFO_PATH, os.path.join(data.work_dir, "geometry_cache"))
+    return lambda: find_tracks(detector_events, element_events, geometry=geometry)
+
+@benchmark("numpy_inference", max_events=20000)
+def bench_numpy_inference(data, num_events):
+    from hit_encoding import convert_to_hit_matrices
+    from numpy_inference import NumpyModel
+
+    # the Dense architecture of reconstruct.create_model with random weights
+    rng = np.random.default_rng(data.seed)
+    sizes = [data.max_detector_id * data.max_element_id, 512, 256, 6]
+    layers = [{"kernel": rng.normal(0, 0.01, (inputs, outputs)).astype(np.float32), "bias": np.zeros(outputs, dtype=np.float32), "activation": activation}
+              for inputs, outputs, activation in zip(sizes[:-1], sizes[1:], ["relu", "relu", "linear"])]
+    model = NumpyModel(layers, (data.max_detector_id, data.max_element_id))
+
+    detector_events, element_events = data.hits(num_events)
+
+    def run():
+        buffer = np.zeros((HIT_MATRIX_CHUNK, data.max_detector_id, data.max_element_id), dtype=np.float32)
+        for start in range(0, num_events, HIT_MATRIX_CHUNK):
+            stop = min(start + HIT_MATRIX_CHUNK, num_events)
+            hit_matrices = convert_to_hit_matrices(detector_events[start:stop], element_events[start:stop], data.max_detector_id,
+                                                   data.max_element_id, out=buffer[:stop - start], dtype=np.float32)
+            model.predict(hit_matrices)
+    return run
+
+# Time one benchmark: best of repeat runs, with the peak memory of the first run.
+# Benchmarks whose optional dependencies are missing are reported as skipped.
+def run_benchmark(name, data, repeat):
+    setup, max_events = BENCHMARKS[name]
+    num_events = data.num_events if max_events is None else min(data.num_events, max_events)
+
+    try:
+        function = setup(data, num_events)
+    except ImportError as error:
+        return {"skipped": "missing dependency: {}".format(error)}
+
+    seconds = []
+    peak_memory_mb = None
+    for run in range(repeat):
+        gc.collect()
+        with PeakMemory() as memory:
+            start_time = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start_time)
+        if run == 0:
+            peak_memory_mb = memory.increase_mb
+
+    best = min(seconds)
+    return {
+        "events": num_events,
+        "seconds": seconds,
+        "best_seconds": best,
+        "events_per_second": num_events / best if best > 0 else None,
+        "peak_memory_mb": peak_memory_mb,
+    }
+
+def _run_benchmark_process(name, data, repeat, connection):
+    try:
+        connection.send(run_benchmark(name, data, repeat))
+    except Exception:
+        connection.send({"failed": traceback.format_exc()})
+
+# run_benchmark in a forked process, so each benchmark starts from the same heap (memory
+# freed by an earlier benchmark can't hide this one's allocations), shares the generated
+# events without copying them, and can't take the suite down if it runs out of memory
+def run_benchmark_isolated(name, data, repeat):
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_benchmark_process, args=(name, data, repeat, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+
+    if result is None:
+        result = {"failed": "benchmark process exited with code {}".format(process.exitcode)}
+    return result
+
+# Commit, machine and library versions the results were measured with
+def environment_info():
+    info = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+    try:
+        info["commit"] = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        info["dirty"] = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip() != ""
+    except (OSError, subprocess.CalledProcessError):
+        info["commit"] = None
+
+    return info
+
+# Print how the best times of results compare with a baseline results file
+def print_comparison(results, baseline):
+    print("\nCompared with {} ({}):".format(baseline["environment"].get("commit"), baseline["environment"]["timestamp"]))
+    for scale, scale_results in results["scales"].items():
+        for name, result in scale_results.items():
+            old = baseline["scales"].get(scale, dict()).get(name)
+            if old is None or "best_seconds" not in old or "best_seconds" not in result:
+                continue
+            if old["events"] != result["events"]:
+                print("  {:>5} {:<26} event counts differ ({} vs {})".format(scale, name, old["events"], result["events"]))
+                continue
+            print("  {:>5} {:<26} {:9.4f} s -> {:9.4f} s  ({:.2f}x)".format(
+                scale, name, old["best_seconds"], result["best_seconds"], old["best_seconds"] / max(result["best_seconds"], 1e-12)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths on synthetic events")
+    parser.add_argument("--scale", action="append", choices=list(SCALES), help="number of events to generate (repeatable, default 1k)")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run (default all)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="timed runs per benchmark; the best is kept")
+    parser.add_argument("--output-dir", default=RESULTS_DIR, help="where the results JSON is written")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic events")
+    args = parser.parse_args()
+
+    scales = args.scale or ["1k"]
+    names = args.only or list(BENCHMARKS)
+    results = {"environment": environment_info(), "scales": dict()}
+
+    for scale in scales:
+        print("Scale {} ({} events)".format(scale, SCALES[scale]))
+        work_dir = tempfile.mkdtemp(prefix="spinquest_bench_")
+        try:
+            # generate the events once, before the benchmark processes fork
+            data = BenchmarkData(SCALES[scale], work_dir, args.seed)
+            data.hits(data.num_events)
+            results["scales"][scale] = dict()
+            for name in names:
+                result = run_benchmark_isolated(name, data, args.repeat)
+                results["scales"][scale][name] = result
+                if "skipped" in result:
+                    print("  {:<26} skipped ({})".format(name, result["skipped"]))
+                elif "failed" in result:
+                    print("  {:<26} failed:\n{}".format(name, result["failed"]))
+                else:
+                    print("  {:<26} {:8d} events {:9.4f} s {:12.0f} events/s {:9.1f} MB peak".format(
+                        name, result["events"], result["best_seconds"], result["events_per_second"] or 0, result["peak_memory_mb"]))
+            del data
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    commit = (results["environment"].get("commit") or "nocommit")[:10]
+    output_path = os.path.join(args.output_dir, "{}_{}_{}.json".format(time.strftime("%Y%m%d-%H%M%S"), commit, "-".join(scales)))
+    with open(output_path, "w") as outfile:
+        json.dump(results, outfile, indent=4)
+    print("Wrote {}".format(output_path))
+
+    if args.compare is not None:
+        with open(args.compare, "r") as infile:
+            print_comparison(results, json.load(infile))
@@ -0,0 +1,110 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from file_read import get_detector_info
+from ragged import HIT_PADDING, RaggedArray, counts_to_offsets
+
+# CONSTANTS
+SPECTROMETER_INFO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spectrometer.csv")
+TREE_NAME = "QA_ana"
+HIT_SLOTS = 500  # width of the fixed-size detectorID/elementID branches in runs/
+TRACKS_PER_EVENT = 2
+NOISE_OCCUPANCY = 0.002  # chance per wire per event of a noise hit
+NEIGHBOUR_FRACTION = 0.1  # track hits that also fire the next wire
+GENERATION_CHUNK = 100000  # events generated per step, which bounds the generator's memory
+
+# Mean track hits per event on a detector, matching the per-detector hit counts of the
+# runs/trackQA samples: every track crosses each wire chamber and prop tube plane, while
+# the split planes (D3p/D3m, the hodoscope halves) see one of the two tracks and each
+# DP quadrant a fraction of them
+def track_hits_per_event(detector_name):
+    if detector_name.startswith("DP"):
+        return TRACKS_PER_EVENT * 0.22
+    if detector_name.startswith("D3") or detector_name.startswith("H"):
+        return TRACKS_PER_EVENT * 0.5
+    return float(TRACKS_PER_EVENT)
+
+# Synthetic detectorID/elementID events over the real channel map, as RaggedArrays.
+# Each detector gets a Poisson number of track hits (around the middle of the plane, some
+# with their neighbouring wire fired too) plus noise hits spread over all its wires.
+def make_hits(num_events, noise_occupancy=NOISE_OCCUPANCY, seed=0, spectrometer_path=SPECTROMETER_INFO_PATH):
+    rng = np.random.default_rng(seed)
+    detectors = [(detector_id, num_elements, track_hits_per_event(name)) for name, (detector_id, num_elements, _) in get_detector_info(spectrometer_path).items()]
+
+    counts, detector_values, element_values = [], [], []
+    for start in range(0, num_events, GENERATION_CHUNK):
+        chunk_events = min(GENERATION_CHUNK, num_events - start)
+        event_indices, chunk_detectors, chunk_elements = [], [], []
+        for detector_id, num_elements, mean_hits in detectors:
+            # track hits, some spilling onto the next wire
+            track_counts = rng.poisson(mean_hits, chunk_events)
+            track_events = np.repeat(np.arange(chunk_events, dtype=np.int32), track_counts)
+            track_elements = np.clip(np.round(rng.normal((num_elements + 1) / 2, num_elements / 5, len(track_events))), 1, num_elements)
+            neighbours = rng.random(len(track_events)) < NEIGHBOUR_FRACTION
+            track_events = np.concatenate([track_events, track_events[neighbours]])
+            track_elements = np.concatenate([track_elements, np.minimum(track_elements[neighbours] + 1, num_elements)])
+
+            # noise
+            noise_events = np.repeat(np.arange(chunk_events, dtype=np.int32), rng.poisson(num_elements * noise_occupancy, chunk_events))
+            noise_elements = rng.integers(1, num_elements + 1, len(noise_events))
+
+            event_indices += [track_events, noise_events]
+            chunk_elements += [track_elements, noise_elements]
+            chunk_detectors.append(np.full(len(track_events) + len(noise_events), detector_id, dtype=np.int16))
+
+        event_index = np.concatenate(event_indices)
+        order = np.argsort(event_index, kind="stable")
+        counts.append(np.bincount(event_index, minlength=chunk_events))
+        detector_values.append(np.concatenate(chunk_detectors)[order])
+        element_values.append(np.concatenate(chunk_elements).astype(np.int16)[order])
+
+    offsets = counts_to_offsets(np.concatenate(counts) if len(counts) > 0 else np.zeros(0, dtype=np.int64))
+    detector_values = np.concatenate(detector_values) if len(detector_values) > 0 else np.zeros(0, dtype=np.int16)
+    element_values = np.concatenate(element_values) if len(element_values) > 0 else np.zeros(0, dtype=np.int16)
+    return RaggedArray(offsets, detector_values), RaggedArray(offsets, element_values)
+
+# Per-track true momenta like the gpx/gpy/gpz branches: object arrays of one float32 per track
+def make_momenta(num_events, seed=0):
+    rng = np.random.default_rng(seed)
+    momenta = []
+    for mean, width in [(0.0, 1.5), (0.0, 1.5), (50.0, 15.0)]:
+        values = rng.normal(mean, width, (num_events, TRACKS_PER_EVENT)).astype(np.float32)
+        events = np.empty(num_events, dtype=object)
+        events[:] = list(values)
+        momenta.append(events)
+
+    return momenta
+
+# Fixed-width (num_events, slots) int32 array of ragged hits padded with HIT_PADDING, the
+# layout of the detectorID/elementID branches. Events with more hits than slots are cut.
+def to_padded(events, slots=HIT_SLOTS):
+    counts = np.minimum(events.counts(), slots)
+    padded = np.full((len(events), slots), HIT_PADDING, dtype=np.int32)
+    event_index = np.repeat(np.arange(len(events)), counts)
+    slot = np.arange(len(event_index)) - np.repeat(counts_to_offsets(counts)[:-1], counts)
+    padded[event_index, slot] = events.values[np.repeat(events.offsets[:-1], counts) + slot]
+    return padded
+
+# Write synthetic events to a ROOT file laid out like runs/trackQA*.root
+def write_root_file(file_path, detector_events, element_events, momenta, step_size=GENERATION_CHUNK):
+    import uproot
+    import awkward as ak
+
+    with uproot.recreate(file_path) as file:
+        for start in range(0, len(detector_events), step_size):
+            stop = min(start + step_size, len(detector_events))
+            chunk = {
+                "n_tracks": np.full(stop - start, TRACKS_PER_EVENT, dtype=np.int32),
+                "detectorID": to_padded(detector_events[start:stop]),
+                "elementID": to_padded(element_events[start:stop]),
+            }
+            for branch, values in zip(["gpx", "gpy", "gpz"], momenta):
+                events = values[start:stop]
+                chunk[branch] = ak.unflatten(np.concatenate(list(events)), [len(event) for event in events])
+
+            if start == 0:
+                file[TREE_NAME] = chunk
+            else:
+                file[TREE_NAME].extend(chunk)
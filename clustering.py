@@ -0,0 +1,90 @@
+import json
+import os
+import numpy as np
+from ragged import RaggedArray, counts_to_offsets, ragged_hits
+
+# CONSTANTS
+CLUSTER_MAX_GAP = 1  # largest element step inside a cluster (1 = only directly adjacent wires)
+ENCODING_SUFFIX = ".encoding.json"  # file next to a saved model recording how its hits were encoded
+
+# Merge hits on neighbouring wires of the same detector into clusters, for many events at once.
+# Hits are sorted by (event, detector, element) through one combined int64 key; repeated hits
+# on a wire are kept once, and a new cluster starts wherever the event or detector changes or
+# the element jumps by more than max_gap. Cluster boundaries come from np.diff, cluster ids
+# from np.cumsum and the cluster sums from np.bincount, so there is no loop over events.
+# Returns a dict of RaggedArrays that share the per-event cluster offsets:
+#   detectorID  detector of the cluster
+#   elementID   fired wire closest to the centroid (the lower one of a tie), so clusters drop
+#               into any consumer of hits (convert_to_hit_matrices, chunk_hits, fit_events, ...)
+#   centroid    mean element of the cluster's wires (float32)
+#   size        number of wires in the cluster
+def cluster_hits(detector_events, element_events, max_gap=CLUSTER_MAX_GAP):
+    detector_events, element_events = ragged_hits(detector_events, element_events)
+    detectors, elements = detector_events.flat(), element_events.flat()
+    event_index = detector_events.event_index()
+
+    # sort by (event, detector, element), dropping repeated hits on a wire
+    order = np.zeros(0, dtype=np.int64)
+    starts = np.zeros(0, dtype=bool)
+    if len(elements) > 0:
+        detector_keys = detectors.astype(np.int64) - detectors.min()
+        element_keys = elements.astype(np.int64) - elements.min()
+        element_span = int(element_keys.max()) + max_gap + 1
+        keys = (event_index * (int(detector_keys.max()) + 1) + detector_keys) * element_span + element_keys
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+
+        distinct = np.ones(len(keys), dtype=bool)
+        distinct[1:] = keys[1:] != keys[:-1]
+        order, keys = order[distinct], keys[distinct]
+
+        # a cluster starts at the first hit of every (event, detector) and after every gap
+        starts = np.ones(len(keys), dtype=bool)
+        starts[1:] = (keys[1:] // element_span != keys[:-1] // element_span) | (np.diff(keys) > max_gap)
+
+    cluster = np.cumsum(starts) - 1
+    first = np.flatnonzero(starts)
+    num_clusters = len(first)
+
+    sorted_elements = elements[order].astype(np.float64)
+    size = np.bincount(cluster, minlength=num_clusters)
+    centroid = np.bincount(cluster, weights=sorted_elements, minlength=num_clusters) / np.maximum(size, 1)
+
+    # first wire of each cluster at the cluster's smallest distance to its centroid
+    central_wire = first
+    if num_clusters > 0:
+        distance = np.abs(sorted_elements - centroid[cluster])
+        nearest = np.flatnonzero(distance <= np.minimum.reduceat(distance, first)[cluster])
+        central_wire = nearest[np.flatnonzero(np.diff(cluster[nearest], prepend=-1))]
+
+    offsets = counts_to_offsets(np.bincount(event_index[order[first]], minlength=len(detector_events)))
+    return {
+        "detectorID": RaggedArray(offsets, detectors[order[first]]),
+        "elementID": RaggedArray(offsets, elements[order[central_wire]]),
+        "centroid": RaggedArray(offsets, centroid.astype(np.float32)),
+        "size": RaggedArray(offsets, size.astype(np.int32)),
+    }
+
+# Hits as a model sees them: unchanged, or with cluster set one hit per cluster (the wire
+# nearest its centroid). Every path that encodes hits for a model goes through here, so
+# training, evaluation and serving see the same input distribution.
+def encode_hits(detector_events, element_events, cluster=False):
+    if not cluster:
+        return detector_events, element_events
+
+    clusters = cluster_hits(detector_events, element_events)
+    return clusters["detectorID"], clusters["elementID"]
+
+# Record next to a saved model whether it was trained on clustered hits
+def save_model_encoding(model_path, cluster):
+    with open(model_path + ENCODING_SUFFIX, "w") as outfile:
+        json.dump({"cluster_hits": bool(cluster)}, outfile, indent=4)
+
+# How the hits of a saved model are encoded; models saved without a record used raw hits
+def load_model_encoding(model_path):
+    encoding = {"cluster_hits": False}
+    if os.path.exists(model_path + ENCODING_SUFFIX):
+        with open(model_path + ENCODING_SUFFIX, "r") as infile:
+            encoding.update(json.load(infile))
+
+    return encoding
@@ -1,12 +1,39 @@
+import argparse
+import numpy as np
 import dash
 import dash_bootstrap_components as dbc
-from dash import dcc, html, Input, Output, State, ALL
-from file_read import read_json, get_detector_info, find_first_non_empty, read_events, choose_root
-from plot import create_detector_heatmaps, create_video
+from dash import dcc, html, Input, Output, State, ALL, Patch, ctx
+from watchdog.observers import Observer
+from file_read import read_json, get_detector_info, find_first_non_empty, choose_root
+from event_source import LazyEventSource, RollingDetectorCounts, WINDOW_SIZE, ROLLING_EVENTS
+from plot import create_detector_heatmaps, create_video, create_heatmap_z, create_heatmap_figure, heatmap_z_values, create_hit_histogram, detector_hit_counts
+from render_cache import LRUCache, Prefetcher
+from watch_data import NewestFileHandler
 
 # CONSTANTS
 SPECTROMETER_INFO_PATH = "spectrometer.csv"
 DETECTOR_MAP_FILE = "detector_map.json"
+# "grid": one heatmap trace built once, event/group changes only patch its z values
+# "subplots": rebuild the figure with one subplot per detector on every change
+HEATMAP_MODE = "grid"
+HEATMAP_CACHE_BYTES = 256 * 1024 * 1024  # memory budget for cached heatmap z values
+PREFETCH_EVENTS = 5  # events before/after the current one rendered in the background
+LIVE_INTERVAL = 2.0  # seconds between checks for new events in live mode
+
+# Command line options (the ROOT file is asked for interactively if --file isn't given)
+parser = argparse.ArgumentParser(description="Detector heatmap dashboard")
+parser.add_argument("--file", help="ROOT file to display")
+parser.add_argument("--tree", help="tree holding the hits (detected automatically if omitted)")
+parser.add_argument("--detector-branch", help="detectorID branch (detected automatically if omitted)")
+parser.add_argument("--element-branch", help="elementID branch (detected automatically if omitted)")
+parser.add_argument("--window-size", type=int, default=WINDOW_SIZE, help="events read from the file at a time")
+parser.add_argument("--video", help="also render the events into VIDEO.mp4 before starting")
+parser.add_argument("--live", action="store_true", help="follow the file as it grows and show its newest events")
+parser.add_argument("--live-dir", help="follow the newest ROOT file written under this directory (implies --live)")
+parser.add_argument("--live-interval", type=float, default=LIVE_INTERVAL, help="seconds between checks for new events")
+parser.add_argument("--rolling-events", type=int, default=ROLLING_EVENTS, help="events in the live hit histogram")
+args, _ = parser.parse_known_args()
+live = args.live or args.live_dir is not None
 
 # Load detector map from JSON
 detector_map = read_json(DETECTOR_MAP_FILE)
@@ -17,31 +44,78 @@ group_to_detectors = {group_name: detectors for category, groups in detector_map
 # Get detector info
 detector_name_to_id_elements = get_detector_info(SPECTROMETER_INFO_PATH)
 max_elements = max([detector_name_to_id_elements[detector_name][1] for detector_name in detector_name_to_id_elements])
-detector_ids, element_ids = read_events(choose_root())
-initial_event_number = find_first_non_empty(detector_ids)
+
+# In live directory mode, watch the directory for the newest run file
+newest_file_handler = None
+if args.live_dir is not None:
+    newest_file_handler = NewestFileHandler(args.live_dir)
+    if newest_file_handler.newest is None:
+        raise Exception("No ROOT files found in {}.".format(args.live_dir))
+    observer = Observer()
+    observer.schedule(newest_file_handler, args.live_dir, recursive=True)
+    observer.daemon = True
+    observer.start()
+
+# Open the ROOT file lazily: only the tree metadata is read here, events are fetched on demand
+if newest_file_handler is not None:
+    file_path = newest_file_handler.newest
+elif args.file is not None:
+    file_path = args.file
+else:
+    file_path = choose_root()
+event_source = LazyEventSource(
+    file_path,
+    tree_name=args.tree,
+    detector_branch=args.detector_branch,
+    element_branch=args.element_branch,
+    window_size=args.window_size
+)
+detector_ids, element_ids = event_source.column("detectorID"), event_source.column("elementID")
+# live mode starts at the newest event (0 for a run file that has no events yet)
+initial_event_number = max(len(event_source) - 1, 0) if live else find_first_non_empty(detector_ids)
+
+# Hits of an event, or no hits for an event that isn't in the file (yet): a live run file can
+# start out empty and fill up over the following live-interval ticks
+def event_hits(event_number):
+    if event_number is not None and 0 <= event_number < len(detector_ids):
+        return detector_ids[event_number], element_ids[event_number]
+    return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)
 
 # Define excluded detectors
 detectors_set = set([detector for group in group_to_detectors for detector in group_to_detectors[group]])
 excluded_detector_ids = set([detector_name_to_id_elements[d][0] for d in detector_name_to_id_elements if d not in detectors_set])
 
-# Create video if user requests it 
-video_response = input("Do you want to process the events in this root file into a video? (y/n): ")
-if video_response.lower() == 'y':
-    video_name = input("What name do you want the video to be? (NO FILE EXTENSION): ")
-    create_video(detector_ids, element_ids, detector_name_to_id_elements, max_elements, initial_event_number, excluded_detector_ids, video_name + ".mp4")
+# Create video if requested on the command line
+if args.video is not None:
+    create_video(detector_ids, element_ids, detector_name_to_id_elements, max_elements, initial_event_number, excluded_detector_ids, args.video + ".mp4")
     print("Done!")
 
 # Filter initial event data
-initial_detector_ids, initial_element_ids = detector_ids[initial_event_number], element_ids[initial_event_number]
+initial_detector_ids, initial_element_ids = event_hits(initial_event_number)
 
 # Generate initial heatmap
-main_heatmap = create_detector_heatmaps(
-    initial_detector_ids,
-    initial_element_ids,
-    detector_name_to_id_elements,
-    max_elements,
-    excluded_detector_ids
-)
+if HEATMAP_MODE == "grid":
+    main_heatmap = create_heatmap_figure(
+        create_heatmap_z(initial_detector_ids, initial_element_ids, detector_name_to_id_elements, max_elements, excluded_detector_ids),
+        detector_name_to_id_elements,
+        max_elements,
+        excluded_detector_ids
+    )
+else:
+    main_heatmap = create_detector_heatmaps(
+        initial_detector_ids,
+        initial_element_ids,
+        detector_name_to_id_elements,
+        max_elements,
+        excluded_detector_ids
+    )
+
+# Hits per detector over the most recent events, shown next to the heatmap in live mode
+if live:
+    max_detector_id = max([detector_name_to_id_elements[detector_name][0] for detector_name in detector_name_to_id_elements])
+    rolling_counts = RollingDetectorCounts(max_detector_id, args.rolling_events)
+    rolling_counts.add(event_source.read_range(max(len(event_source) - args.rolling_events, 0), len(event_source))[0])
+    hit_histogram = create_hit_histogram(rolling_counts.total, detector_name_to_id_elements, excluded_detector_ids, args.rolling_events)
 
 # Initialize Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], suppress_callback_exceptions=True)
@@ -64,6 +138,26 @@ def layout():
         for group in group_to_detectors
     ]
 
+    # Live mode: newest-event polling, follow toggle, status line and hit histogram
+    live_elements = []
+    if live:
+        live_elements = [
+            dcc.Interval(id="live-interval", interval=int(args.live_interval * 1000)),
+            dcc.Store(id="live-event"),
+            dbc.Row([
+                dbc.Col([
+                    dcc.Checklist(
+                        options=[{"label": " Follow newest event", "value": "follow"}],
+                        value=["follow"],
+                        id="live-follow",
+                        inline=True,
+                    ),
+                    html.Span(id="live-status", className="ms-3"),
+                ], width=12, className="text-center mb-2"),
+            ]),
+            dcc.Graph(id="hit-histogram", figure=hit_histogram),
+        ]
+
     return html.Div([
         html.H1(
             "Detector Heatmap", 
@@ -79,6 +173,7 @@ def layout():
                 ], width=12, className="text-center mb-2"),
             ]),
             dcc.Graph(id="heatmap-graph", figure=main_heatmap, style={"margin-bottom": "5px"}),  # Further reduced margin-bottom
+            *live_elements,
             dbc.Card(
                 [
                     dbc.CardHeader(
@@ -97,14 +192,46 @@ def layout():
 
 app.layout = layout()
 
+# Heatmap z values for (event, displayed detectors), most recently used kept in memory
+heatmap_cache = LRUCache(HEATMAP_CACHE_BYTES)
+
+# (the file is part of the key since live directory mode can switch files)
+def render_heatmap_values(event_number, displayed_detectors):
+    key = (event_source.file_path, event_number, displayed_detectors)
+    values = heatmap_cache.get(key)
+    if values is None:
+        event_detector_ids, event_element_ids = event_hits(event_number)
+        z = create_heatmap_z(
+            event_detector_ids,
+            event_element_ids,
+            detector_name_to_id_elements,
+            max_elements,
+            excluded_detector_ids,
+            displayed_detectors
+        )
+        values = heatmap_z_values(z)
+        # roughly one list slot per cell; an event that hasn't been written yet isn't cached
+        if event_number is not None and 0 <= event_number < len(detector_ids):
+            heatmap_cache.put(key, values, z.size * 8)
+
+    return values
+
+heatmap_prefetcher = Prefetcher(render_heatmap_values)
+
 # Callback to update the heatmap dynamically
 @app.callback(
     Output("heatmap-graph", "figure"),
     [Input("update-button", "n_clicks"),
-     Input({"type": "group-checklist", "index": ALL}, "value")],
+     Input({"type": "group-checklist", "index": ALL}, "value")] +
+    ([Input("live-event", "data")] if live else []),
     State("event-number-input", "value"),
 )
-def update_heatmap(n_clicks, selected_groups, event_number):
+def update_heatmap(n_clicks, selected_groups, *live_event_and_event_number):
+    # in live mode a new event arriving also updates the plot
+    event_number = live_event_and_event_number[-1]
+    if live and ctx.triggered_id == "live-event":
+        event_number = live_event_and_event_number[0]
+
     # Flatten selected groups from nested lists
     selected_groups = [item for sublist in selected_groups for item in sublist if item]
 
@@ -120,14 +247,69 @@ def update_heatmap(n_clicks, selected_groups, event_number):
     for detector in detector_name_to_id_elements:
         detector_name_to_id_elements[detector][-1] = detector in selected_detectors
 
+    # Only send the new z values; axes and labels stay as built at startup
+    if HEATMAP_MODE == "grid":
+        displayed_detectors = frozenset(selected_detectors)
+        patched_heatmap = Patch()
+        patched_heatmap["data"][0]["z"] = render_heatmap_values(event_number, displayed_detectors)
+
+        # render the neighbouring events in the background, nearest first (there are none
+        # while the event number box is empty)
+        if event_number is not None:
+            neighbours = []
+            for distance in range(1, PREFETCH_EVENTS + 1):
+                for neighbour in (event_number + distance, event_number - distance):
+                    if 0 <= neighbour < len(detector_ids):
+                        neighbours.append((neighbour, displayed_detectors))
+            heatmap_prefetcher.schedule(neighbours)
+
+        return patched_heatmap
+
     # Generate new heatmap
     return create_detector_heatmaps(
-        detector_ids[event_number],
-        element_ids[event_number],
+        *event_hits(event_number),
         detector_name_to_id_elements,
         max_elements,
         excluded_detector_ids
     )
 
+# Live mode: on every interval tick pick up the entries written since the last tick (or the
+# newest run file), add only those to the hit histogram and move to the newest event
+if live:
+    @app.callback(
+        [Output("event-number-input", "value"),
+         Output("live-event", "data"),
+         Output("hit-histogram", "figure"),
+         Output("live-status", "children")],
+        Input("live-interval", "n_intervals"),
+        State("live-follow", "value"),
+        prevent_initial_call=True,
+    )
+    def follow_live_run(n_intervals, follow):
+        file_path = newest_file_handler.newest if newest_file_handler is not None else None
+        switched = file_path is not None and file_path != event_source.file_path
+        try:
+            first_new = event_source.refresh(file_path)
+        except Exception as error:
+            # e.g. the run file isn't readable between ROOT autosaves; try again next tick
+            return dash.no_update, dash.no_update, dash.no_update, "Waiting for {}: {}".format(file_path or event_source.file_path, error)
+
+        num_events = len(event_source)
+        status = "Live: {} ({} events, {} new)".format(event_source.file_path, num_events, num_events - first_new)
+        if switched:
+            rolling_counts.clear()
+        if first_new >= num_events:
+            return dash.no_update, dash.no_update, dash.no_update, status
+
+        # events older than the histogram window don't need to be read at all
+        new_detector_ids, _ = event_source.read_range(max(first_new, num_events - args.rolling_events), num_events)
+        rolling_counts.add(new_detector_ids)
+        patched_histogram = Patch()
+        patched_histogram["data"][0]["y"] = detector_hit_counts(rolling_counts.total, detector_name_to_id_elements, excluded_detector_ids)
+
+        if follow:
+            return num_events - 1, num_events - 1, patched_histogram, status
+        return dash.no_update, dash.no_update, patched_histogram, status
+
 if __name__ == "__main__":
     app.run_server(debug=False)
@@ -0,0 +1,250 @@
+import numpy as np
+import uproot
+import hashlib
+import json
+import os
+import shutil
+from file_read import iter_events, resolve_schema, choose_branch
+from ragged import RaggedArray, ragged_hits, flatten_events
+
+# CONSTANTS
+CACHE_DIR = ".event_cache"
+CACHE_VERSION = 1
+HIT_BRANCHES = ["detectorID", "elementID"]
+TRACK_BRANCHES = ["gpx", "gpy", "gpz"]
+EVENT_LEVEL_BRANCHES = ["n_tracks"]
+COPY_BLOCK_SIZE = 1 << 24
+INDEX_FILE = "index.json"  # catalogue of converted files kept in the cache directory
+
+# Appends chunks of a 1D column to a raw file, then turns it into a .npy file on close.
+# The length of a column is only known once the whole ROOT file has been read, so the
+# data goes through a raw file first to keep memory bounded by the chunk size.
+class _ColumnWriter:
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._raw_path = path + ".part"
+        self._raw = open(self._raw_path, "wb")
+
+    def append(self, values):
+        values = np.ascontiguousarray(values, dtype=self.dtype)
+        values.tofile(self._raw)
+        self.length += len(values)
+
+    def close(self):
+        self._raw.close()
+
+        out = np.lib.format.open_memmap(self.path, mode="w+", dtype=self.dtype, shape=(self.length,))
+        if self.length > 0:
+            raw = np.memmap(self._raw_path, dtype=self.dtype, mode="r", shape=(self.length,))
+            for start in range(0, self.length, COPY_BLOCK_SIZE):
+                out[start:start + COPY_BLOCK_SIZE] = raw[start:start + COPY_BLOCK_SIZE]
+            del raw
+        out.flush()
+        del out
+
+        os.remove(self._raw_path)
+
+# Writes a CSR-style ragged column: an offsets array plus one values array per branch
+class _RaggedWriter:
+    def __init__(self, directory, offsets_name, branch_dtypes):
+        self.offsets = _ColumnWriter(os.path.join(directory, offsets_name + ".npy"), np.int64)
+        self.offsets.append(np.zeros(1, dtype=np.int64))
+        self.total = 0
+        self.values = {branch: _ColumnWriter(os.path.join(directory, branch + ".npy"), dtype) for branch, dtype in branch_dtypes.items()}
+
+    def append(self, counts, values):
+        self.offsets.append(self.total + np.cumsum(counts))
+        self.total += int(np.sum(counts))
+        for branch in self.values:
+            self.values[branch].append(values[branch])
+
+    def close(self):
+        self.offsets.close()
+        for writer in self.values.values():
+            writer.close()
+
+# Cache directory for a ROOT file, keyed by its absolute path, size and modification time
+def cache_path(file_path, cache_dir=CACHE_DIR):
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    key = "{}|{}|{}|{}".format(file_path, stat.st_size, stat.st_mtime_ns, CACHE_VERSION)
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(file_path))[0]
+
+    return os.path.join(cache_dir, "{}-{}".format(name, digest))
+
+# Convert a ROOT file into a cache directory of flat .npy arrays (one-time cost per file).
+# branch_names maps the hit branches to the branches of the file holding them (as returned
+# by resolve_schema); whatever isn't given is resolved here, raising instead of asking when
+# interactive=False. The cache always stores the canonical branch names.
+def build_cache(file_path, cache_dir=CACHE_DIR, tree_name=None, step_size=None, branch_names=None, interactive=True):
+    directory = cache_path(file_path, cache_dir)
+    branch_names = dict(branch_names or dict())
+
+    with uproot.open(file_path) as file:
+        if tree_name is None:
+            tree_name, resolved_branches = resolve_schema(file, HIT_BRANCHES, interactive=interactive)
+            branch_names = {**resolved_branches, **branch_names}
+        keys = file[tree_name].keys()
+        num_events = file[tree_name].num_entries
+
+    for branch in HIT_BRANCHES:
+        if branch not in branch_names:
+            branch_names[branch] = choose_branch(keys, branch, interactive)
+        if branch_names[branch] not in keys:
+            raise Exception("Branch {} missing from {}.".format(branch_names[branch], file_path))
+
+    # optional branches are kept when the file has exactly one branch holding them
+    for branch in TRACK_BRANCHES + EVENT_LEVEL_BRANCHES:
+        candidates = [branch] if branch in keys else [key for key in keys if branch in key]
+        if branch not in branch_names and len(candidates) == 1:
+            branch_names[branch] = candidates[0]
+    track_branches = [branch for branch in TRACK_BRANCHES if branch in branch_names]
+    event_branches = [branch for branch in EVENT_LEVEL_BRANCHES if branch in branch_names]
+
+    # write into a temporary directory so an interrupted conversion never looks complete
+    temp_directory = directory + ".tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+
+    hit_writer = _RaggedWriter(temp_directory, "hit_offsets", {"detectorID": np.int32, "elementID": np.int32})
+    track_writer = None
+    if len(track_branches) > 0:
+        track_writer = _RaggedWriter(temp_directory, "track_offsets", {branch: np.float32 for branch in track_branches})
+    event_writers = {branch: _ColumnWriter(os.path.join(temp_directory, branch + ".npy"), np.int32) for branch in event_branches}
+
+    branches = HIT_BRANCHES + track_branches + event_branches
+    kwargs = {} if step_size is None else {"step_size": step_size}
+    for chunk in iter_events(file_path, branches, tree_name=tree_name, branch_names=branch_names, **kwargs):
+        detector_ids, element_ids = ragged_hits(chunk["detectorID"], chunk["elementID"])
+        hit_writer.append(detector_ids.counts(), {"detectorID": detector_ids.flat(), "elementID": element_ids.flat()})
+
+        if track_writer is not None:
+            track_values = {}
+            for branch in track_branches:
+                track_counts, track_values[branch] = flatten_events(chunk[branch])
+            track_writer.append(track_counts, track_values)
+
+        for branch in event_branches:
+            event_writers[branch].append(chunk[branch])
+
+    hit_writer.close()
+    if track_writer is not None:
+        track_writer.close()
+    for writer in event_writers.values():
+        writer.close()
+
+    meta = {
+        "source": os.path.abspath(file_path),
+        "tree": tree_name,
+        "branches": {branch: branch_names[branch] for branch in branches},
+        "num_events": num_events,
+        "track_branches": track_branches,
+        "event_branches": event_branches,
+        "version": CACHE_VERSION,
+    }
+    with open(os.path.join(temp_directory, "meta.json"), "w") as outfile:
+        json.dump(meta, outfile, indent=4)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(temp_directory, directory)
+
+    return directory
+
+# Open the cache for a ROOT file, building it first if it doesn't exist or is stale.
+# Returns a dict of branch name -> memory-mapped column; hit and track branches are RaggedArrays.
+def open_cache(file_path, cache_dir=CACHE_DIR, tree_name=None, branch_names=None, interactive=True):
+    directory = cache_path(file_path, cache_dir)
+    if not os.path.exists(os.path.join(directory, "meta.json")):
+        print("Building event cache for {}...".format(file_path))
+        build_cache(file_path, cache_dir, tree_name, branch_names=branch_names, interactive=interactive)
+
+    meta = read_cache_meta(directory)
+
+    def load(name):
+        return np.load(os.path.join(directory, name + ".npy"), mmap_mode="r")
+
+    columns = {}
+    hit_offsets = load("hit_offsets")
+    for branch in HIT_BRANCHES:
+        columns[branch] = RaggedArray(hit_offsets, load(branch))
+    if len(meta["track_branches"]) > 0:
+        track_offsets = load("track_offsets")
+        for branch in meta["track_branches"]:
+            columns[branch] = RaggedArray(track_offsets, load(branch))
+    for branch in meta["event_branches"]:
+        columns[branch] = load(branch)
+
+    return columns
+
+# Read the meta.json of a cache directory
+def read_cache_meta(directory):
+    with open(os.path.join(directory, "meta.json"), "r") as infile:
+        return json.load(infile)
+
+# Remove cache directories whose ROOT file was modified or no longer exists, together with
+# any index entries that point at a cache directory that is gone. Returns the removed
+# directories. Like update_cache_index, callers serialize it with other index updates.
+def prune_cache(cache_dir=CACHE_DIR):
+    if not os.path.isdir(cache_dir):
+        return []
+
+    removed = []
+    for name in os.listdir(cache_dir):
+        # leave conversions that are still in progress alone
+        if name.endswith(".tmp"):
+            continue
+
+        directory = os.path.join(cache_dir, name)
+        if not os.path.isdir(directory):
+            continue
+        meta_path = os.path.join(directory, "meta.json")
+        if not os.path.exists(meta_path):
+            shutil.rmtree(directory, ignore_errors=True)
+            removed.append(directory)
+            continue
+
+        source = read_cache_meta(directory)["source"]
+        if not os.path.exists(source) or cache_path(source, cache_dir) != directory:
+            shutil.rmtree(directory, ignore_errors=True)
+            removed.append(directory)
+
+    index = read_cache_index(cache_dir)
+    kept = {file_path: entry for file_path, entry in index.items() if os.path.exists(os.path.join(entry["directory"], "meta.json"))}
+    if len(kept) != len(index):
+        write_cache_index(kept, cache_dir)
+
+    return removed
+
+# Read the catalogue of converted files: ROOT file path -> cache directory and event count
+def read_cache_index(cache_dir=CACHE_DIR):
+    index_path = os.path.join(cache_dir, INDEX_FILE)
+    if not os.path.exists(index_path):
+        return dict()
+
+    with open(index_path, "r") as infile:
+        return json.load(infile)
+
+# Record a converted file in the catalogue; callers serialize concurrent updates
+def update_cache_index(file_path, directory, cache_dir=CACHE_DIR):
+    meta = read_cache_meta(directory)
+    index = read_cache_index(cache_dir)
+    index[os.path.abspath(file_path)] = {
+        "directory": os.path.abspath(directory),
+        "tree": meta["tree"],
+        "num_events": meta["num_events"],
+        "size": os.path.getsize(file_path),
+    }
+
+    write_cache_index(index, cache_dir)
+
+    return index
+
+# Replace the catalogue through a temporary file so readers never see it half written
+def write_cache_index(index, cache_dir=CACHE_DIR):
+    index_path = os.path.join(cache_dir, INDEX_FILE)
+    with open(index_path + ".tmp", "w") as outfile:
+        json.dump(index, outfile, indent=4)
+    os.replace(index_path + ".tmp", index_path)
@@ -0,0 +1,181 @@
+import threading
+import numpy as np
+import uproot
+from collections import OrderedDict
+from file_read import resolve_schema
+from event_cache import HIT_BRANCHES
+from ragged import ragged_hits, concatenate_ragged
+
+# CONSTANTS
+WINDOW_SIZE = 1000  # events read per entry_start/entry_stop window
+MAX_WINDOWS = 4  # windows kept in memory
+ROLLING_EVENTS = 1000  # events counted by RollingDetectorCounts
+
+# Reads the hits of a ROOT file on demand. Opening the source only reads the tree metadata;
+# events are fetched in windows of window_size entries around the requested event and the
+# most recent windows are kept, so startup time doesn't depend on the size of the run.
+class LazyEventSource:
+    def __init__(self, file_path, tree_name=None, detector_branch=None, element_branch=None,
+                 window_size=WINDOW_SIZE, max_windows=MAX_WINDOWS):
+        self.file_path = file_path
+        self.window_size = window_size
+        self.max_windows = max_windows
+        self._file = uproot.open(file_path)
+        self._windows = OrderedDict()
+        # guards the open file and the windows; every read of the tree holds it, so refresh
+        # never closes a file that a callback is still reading from
+        self._lock = threading.RLock()
+
+        # fill in whatever wasn't given from the saved/auto-detected schema resolution
+        if tree_name is None or detector_branch is None or element_branch is None:
+            resolved_tree, resolved_branches = resolve_schema(self._file, HIT_BRANCHES)
+            tree_name = tree_name or resolved_tree
+            detector_branch = detector_branch or resolved_branches["detectorID"]
+            element_branch = element_branch or resolved_branches["elementID"]
+
+        self.tree_name = tree_name
+        self.branches = [detector_branch, element_branch]
+        self.tree = self._file[tree_name]
+        self.num_events = self.tree.num_entries
+
+    def __len__(self):
+        return self.num_events
+
+    # (start, detector ids, element ids) of the window holding event index
+    def _window(self, index):
+        start = (index // self.window_size) * self.window_size
+
+        with self._lock:
+            stop = min(start + self.window_size, self.num_events)
+            if start in self._windows:
+                detector_ids, element_ids = self._windows[start]
+                self._windows.move_to_end(start)
+                if start + len(detector_ids) >= stop:
+                    return detector_ids, element_ids
+
+                # the window was read before the file grew: only read the entries added since
+                new_detector_ids, new_element_ids = self.read_range(start + len(detector_ids), stop)
+                detector_ids = concatenate_ragged([detector_ids, new_detector_ids])
+                element_ids = concatenate_ragged([element_ids, new_element_ids])
+            else:
+                detector_ids, element_ids = self.read_range(start, stop)
+
+            self._windows[start] = (detector_ids, element_ids)
+            while len(self._windows) > self.max_windows:
+                self._windows.popitem(last=False)
+
+        return detector_ids, element_ids
+
+    # Pick up entries appended since the file was last read, or switch to another file with the
+    # same layout. Only the tree metadata is re-read here; a cached window that ended at the old
+    # last event is topped up with just the new entries the next time it's used.
+    # Returns the index of the first new event.
+    def refresh(self, file_path=None):
+        file_path = file_path or self.file_path
+        new_file = uproot.open(file_path)
+        try:
+            new_tree = new_file[self.tree_name]
+            num_events = new_tree.num_entries
+        except Exception:
+            new_file.close()
+            raise
+
+        with self._lock:
+            if file_path != self.file_path:
+                first_new = 0
+                self._windows.clear()
+            else:
+                first_new = self.num_events
+
+            old_file = self._file
+            self.file_path, self._file, self.tree, self.num_events = file_path, new_file, new_tree, num_events
+            old_file.close()
+
+        return first_new
+
+    # detector ids and element ids of events [start, stop) as RaggedArrays, read in one go
+    # without going through the window cache
+    def read_range(self, start, stop):
+        with self._lock:
+            arrays = self.tree.arrays(self.branches, entry_start=start, entry_stop=stop, library="np")
+        return ragged_hits(arrays[self.branches[0]], arrays[self.branches[1]])
+
+    # detector ids and element ids of one event (padding slots removed)
+    def event(self, index):
+        with self._lock:
+            if index < 0:
+                index += self.num_events
+            if index < 0 or index >= self.num_events:
+                raise IndexError("Event {} out of range for {} events.".format(index, self.num_events))
+
+            detector_ids, element_ids = self._window(index)
+        offset = index % self.window_size
+        return detector_ids[offset], element_ids[offset]
+
+    # array-like view of one branch ("detectorID" or "elementID") for code that indexes events
+    def column(self, branch):
+        return LazyEventColumn(self, HIT_BRANCHES.index(branch))
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+# One branch of a LazyEventSource, indexable like the arrays read_events returns. A slice
+# of events is read in one go (read_range) and comes back as a RaggedArray.
+class LazyEventColumn:
+    def __init__(self, source, position):
+        self.source = source
+        self.position = position
+
+    def __len__(self):
+        return len(self.source)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self.source))
+            if step != 1:
+                raise Exception("Only contiguous slices of events can be read.")
+            return self.source.read_range(start, max(start, stop))[self.position]
+
+        return self.source.event(index)[self.position]
+
+# Hits per detector over the last num_events events. Per-event counts sit in a ring buffer and
+# a running total is kept, so adding events costs time proportional to the new events only.
+class RollingDetectorCounts:
+    def __init__(self, max_detector_id, num_events=ROLLING_EVENTS):
+        self.num_events = num_events
+        self.event_counts = np.zeros((num_events, max_detector_id + 1), dtype=np.int64)
+        self.total = np.zeros(max_detector_id + 1, dtype=np.int64)
+        self.num_seen = 0
+
+    # add events given as RaggedArrays of detector ids (as returned by read_range)
+    def add(self, detector_events):
+        num_new = len(detector_events)
+        if num_new == 0:
+            return
+        max_detector_id = self.event_counts.shape[1] - 1
+
+        # only the last num_events of a large batch can stay in the window
+        skip = max(num_new - self.num_events, 0)
+        event_index = detector_events.event_index()
+        detector_ids = np.asarray(detector_events.flat(), dtype=np.int64)
+        keep = (event_index >= skip) & (detector_ids >= 0) & (detector_ids <= max_detector_id)
+        new_counts = np.bincount(
+            (event_index[keep] - skip) * (max_detector_id + 1) + detector_ids[keep],
+            minlength=(num_new - skip) * (max_detector_id + 1)
+        ).reshape(num_new - skip, max_detector_id + 1)
+
+        slots = (self.num_seen + skip + np.arange(num_new - skip)) % self.num_events
+        self.total -= self.event_counts[slots].sum(axis=0)
+        self.total += new_counts.sum(axis=0)
+        self.event_counts[slots] = new_counts
+        self.num_seen += num_new
+
+    # events currently counted
+    def __len__(self):
+        return min(self.num_seen, self.num_events)
+
+    def clear(self):
+        self.event_counts[:] = 0
+        self.total[:] = 0
+        self.num_seen = 0
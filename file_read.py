@@ -3,6 +3,16 @@ import uproot
 import time
 import os
 import json 
+import hashlib
+from ragged import RaggedArray, concatenate_ragged, from_awkward
+
+# CONSTANTS
+EVENT_BRANCHES = ["detectorID", "elementID", "gpx", "gpy", "gpz"]
+DEFAULT_STEP_SIZE = 10000
+SCHEMA_RESOLUTIONS_FILE = ".schema_resolutions.json"
+
+# tree/branch choices made for each file layout, keyed by schema_key
+schema_resolutions = dict()
 
 # Function for reading detector names from spectrometer CSV file
 def get_detector_info(file_name):
@@ -47,6 +57,34 @@ def is_file_still_writing(file_path, interval=0.1):
     # Returns False if the file size didn't change, and True if the file size did change
     return initial_size != new_size
 
+# Check without waiting whether a ROOT file has been fully written: the header must point to
+# an end of file (fEND) that is already on disk, and uproot must be able to read the keys of
+# the top directory, which ROOT only writes when the file is closed
+def is_root_file_complete(file_path):
+    try:
+        with open(file_path, "rb") as infile:
+            header = infile.read(20)
+        if len(header) < 16 or header[:4] != b"root":
+            return False
+
+        # files with fVersion >= 1000000 use 64 bit pointers
+        version = int.from_bytes(header[4:8], "big")
+        if version >= 1000000:
+            if len(header) < 20:
+                return False
+            end = int.from_bytes(header[12:20], "big")
+        else:
+            end = int.from_bytes(header[12:16], "big")
+        if os.path.getsize(file_path) < end:
+            return False
+
+        with uproot.open(file_path) as file:
+            file.keys()
+    except Exception:
+        return False
+
+    return True
+
 # Function for finding first non-empty array
 def find_first_non_empty(arr):
     for first_non_empty in range(len(arr)):
@@ -55,7 +93,8 @@ def find_first_non_empty(arr):
         
     return -1
 
-# Function for asking for user input
+# Function for asking for user input (unattended callers pass interactive=False to the
+# choose_*/resolve_schema functions instead of reaching this)
 def choose_option(options):
     while True:
         response = input("Please select an option by number: ")
@@ -66,22 +105,38 @@ def choose_option(options):
     
     return choice
 
-# Find tree in ROOT file
-def find_tree(file):
+# Ask which tree in a ROOT file to use and return its name (no question if there is only one).
+# With interactive=False an ambiguous file raises instead of asking.
+def choose_tree_name(file, interactive=True):
     # use user input to find tree
     tree_names = file.keys()
     if len(tree_names) == 0:
         raise Exception("No trees found in ROOT file.")
+    if len(tree_names) == 1:
+        return tree_names[0]
+    if not interactive:
+        raise Exception("Several trees found in ROOT file ({}); the tree has to be given.".format(", ".join(tree_names)))
     
     print("Trees found in file: ")
     for i, tree_name in enumerate(tree_names, 1):
         print("{}. ".format(i) + tree_name)
     choice = choose_option(tree_names)
 
-    return file[tree_names[choice]]
+    return tree_names[choice]
+
+# Find tree in ROOT file
+def find_tree(file):
+    return file[choose_tree_name(file)]
+
+# Function that reads events from ROOT file.
+# If cache_dir is given, the events come from the on-disk event cache (built on first use)
+# as memory-mapped RaggedArrays holding only the real hits of each event.
+def read_events(file_path, cache_dir=None):
+    if cache_dir is not None:
+        from event_cache import open_cache
+        columns = open_cache(file_path, cache_dir)
+        return columns["detectorID"], columns["elementID"]
 
-# Function that reads events from ROOT file
-def read_events(file_path):
     detector_ids = []
     element_ids = []
 
@@ -120,6 +175,122 @@ def read_events(file_path):
     
     return detector_ids, element_ids
 
+# Join the pieces of one branch read by iter_events
+def concatenate_columns(arrays):
+    if isinstance(arrays[0], RaggedArray):
+        return concatenate_ragged(arrays)
+    return np.concatenate(arrays)
+
+# Generator that yields batches of step_size events from any number of ROOT files.
+# Each batch is a dict of branch name -> array, and only about two batches are held in
+# memory at a time, so runs of any size can be processed at constant memory. Batches
+# span file boundaries; only the last batch can be shorter than step_size.
+# Baskets are read as awkward arrays and converted by ragged.from_awkward, so jagged
+# branches (gpx, gpy, gpz) come out as RaggedArrays built from their offsets and
+# fixed-width branches as regular NumPy arrays.
+# branch_names maps requested branches to the branches of the file holding them (as
+# returned by resolve_schema); batches are keyed by the requested names either way.
+def iter_events(file_paths, branches=EVENT_BRANCHES, step_size=DEFAULT_STEP_SIZE, tree_name=None, branch_names=None):
+    if isinstance(file_paths, str):
+        file_paths = [file_paths]
+    if step_size <= 0:
+        raise Exception("step_size must be a positive number of events.")
+
+    branch_names = branch_names or dict()
+    file_branches = [branch_names.get(branch, branch) for branch in branches]
+    pending = {branch: [] for branch in branches}
+    num_pending = 0
+
+    for file_path in file_paths:
+        with uproot.open(file_path) as file:
+            # ask for the tree once and reuse it for the remaining files
+            if tree_name is None:
+                tree_name = choose_tree_name(file)
+            tree = file[tree_name]
+
+            missing_branches = [branch for branch in file_branches if branch not in tree.keys()]
+            if len(missing_branches) > 0:
+                raise Exception("Branches {} missing from {}.".format(missing_branches, file_path))
+
+            for chunk in tree.iterate(file_branches, step_size=step_size, library="ak"):
+                for branch, file_branch in zip(branches, file_branches):
+                    pending[branch].append(from_awkward(chunk[file_branch]))
+                num_pending += len(chunk[file_branches[0]])
+
+                # emit full batches, keeping whatever is left over for the next chunk/file
+                while num_pending >= step_size:
+                    joined = {branch: concatenate_columns(pending[branch]) for branch in branches}
+                    yield {branch: joined[branch][:step_size] for branch in branches}
+
+                    num_pending -= step_size
+                    pending = {branch: [joined[branch][step_size:]] for branch in branches}
+
+    if num_pending > 0:
+        yield {branch: concatenate_columns(pending[branch]) for branch in branches}
+
+# Key identifying the layout of a ROOT file (its trees and their branches)
+def schema_key(file):
+    layout = {tree_name: sorted(file[tree_name].keys()) for tree_name in file.keys()}
+    return hashlib.sha1(json.dumps(layout, sort_keys=True).encode()).hexdigest()
+
+# Pick the branch in a tree that holds a canonical branch, asking only if it is ambiguous
+# (or, with interactive=False, raising)
+def choose_branch(tree_keys, branch, interactive=True):
+    if branch in tree_keys:
+        return branch
+
+    candidates = [key for key in tree_keys if branch in key]
+    if len(candidates) == 0:
+        raise Exception("Branch {} missing from ROOT file.".format(branch))
+    if len(candidates) == 1:
+        return candidates[0]
+    if not interactive:
+        raise Exception("Several branches found for {} ({}).".format(branch, ", ".join(candidates)))
+
+    print("More than 2 valid branches found for {}. Please select the one you want.".format(branch))
+    for i, candidate in enumerate(candidates, 1):
+        print("{}. ".format(i) + candidate)
+    return candidates[choose_option(candidates)]
+
+# Load the schema resolutions saved by earlier runs
+def load_schema_resolutions(file_name=SCHEMA_RESOLUTIONS_FILE):
+    if os.path.exists(file_name):
+        schema_resolutions.update(read_json(file_name))
+
+# Work out which tree and branches of a file hold the canonical branches. The answer is
+# remembered per file layout (and saved to resolutions_file) so later files with the same
+# layout, including ones in later runs, are resolved without any prompts. Background threads
+# pass interactive=False so a layout that hasn't been resolved before raises instead of
+# waiting for an answer.
+def resolve_schema(file, branches, resolutions_file=SCHEMA_RESOLUTIONS_FILE, interactive=True):
+    if len(schema_resolutions) == 0 and resolutions_file is not None:
+        load_schema_resolutions(resolutions_file)
+
+    key = schema_key(file)
+    resolution = schema_resolutions.get(key)
+    if resolution is not None and all(branch in resolution["branches"] for branch in branches):
+        return resolution["tree"], resolution["branches"]
+
+    if resolution is not None:
+        tree_name = resolution["tree"]
+    elif len(file.keys()) == 1:
+        tree_name = file.keys()[0]
+    else:
+        tree_name = choose_tree_name(file, interactive)
+
+    tree_keys = file[tree_name].keys()
+    resolved_branches = dict() if resolution is None else resolution["branches"]
+    for branch in branches:
+        if branch not in resolved_branches:
+            resolved_branches[branch] = choose_branch(tree_keys, branch, interactive)
+
+    schema_resolutions[key] = {"tree": tree_name, "branches": resolved_branches}
+    if resolutions_file is not None:
+        with open(resolutions_file, 'w') as outfile:
+            json.dump(schema_resolutions, outfile, indent=4)
+
+    return tree_name, resolved_branches
+
 # Function for choosing which root file to read
 def choose_root(directory="./root_files"):
     root_files = os.listdir(directory)
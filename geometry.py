@@ -0,0 +1,148 @@
+import numpy as np
+import hashlib
+import os
+import shutil
+
+# CONSTANTS
+SPECTROMETER_INFO_PATH = "spectrometer.csv"
+GEOMETRY_CACHE_DIR = ".geometry_cache"
+GEOMETRY_VERSION = 1
+# per-wire lookup columns, each a (max_detector_id + 1, max_element_id + 1) array
+FLOAT_FIELDS = ["position", "x", "y", "z", "cos", "sin", "spacing", "cell_width"]
+INT_FIELDS = ["plane"]
+
+# Read every row of the spectrometer CSV as a dict of column name -> value. Unlike
+# get_detector_info this keeps the geometry columns and every prop tube module row.
+def read_spectrometer_rows(file_name=SPECTROMETER_INFO_PATH):
+    rows = []
+    with open(file_name, 'r') as infile:
+        columns = infile.readline().strip().split(",")
+        for line in infile.readlines():
+            if line.strip() == "":
+                continue
+            values = dict(zip(columns, line.strip().split(",")))
+            row = {column: float(value) for column, value in values.items() if column not in ("det_ID", "det_name", "n_ele")}
+            row["det_ID"] = int(values["det_ID"])
+            row["det_name"] = values["det_name"]
+            row["n_ele"] = int(values["n_ele"])
+            rows.append(row)
+
+    return rows
+
+# Wire geometry of the whole spectrometer as lookup arrays indexed by [detectorID, elementID],
+# so turning any number of hits into coordinates is one fancy-indexing step per column.
+# For every wire:
+#   position    measured coordinate (cm) along the plane's measurement direction (cos, sin),
+#               spacing * (element - (n_ele + 1) / 2) + xoffset + x0 * cos + y0 * sin
+#   x, y        point where the wire crosses the plane's center line
+#   z           z of the plane (cm)
+#   cos, sin    measurement direction, from angle_from_vert plus the plane's theta_z rotation
+#   plane       index of the detector in plane_ids (ordered by z), -1 where there's no wire
+# Detectors made of several modules (the prop tubes, 9 rows of 8 tubes per det_ID) number
+# their elements across the modules in order of increasing measured coordinate.
+class DetectorGeometry:
+    def __init__(self, arrays, plane_ids, plane_names):
+        self.plane_ids = plane_ids
+        self.plane_names = plane_names
+        for field in FLOAT_FIELDS + INT_FIELDS:
+            setattr(self, field, arrays[field])
+        self.valid = self.plane >= 0
+        self.max_detector_id = self.plane.shape[0] - 1
+        self.max_element_id = self.plane.shape[1] - 1
+
+    # Build the lookup arrays from the rows of the spectrometer CSV
+    @classmethod
+    def from_rows(cls, rows):
+        modules = dict()
+        for row in rows:
+            modules.setdefault(row["det_ID"], []).append(row)
+
+        max_detector_id = max(modules)
+        max_element_id = max(sum(row["n_ele"] for row in detector_rows) for detector_rows in modules.values())
+        shape = (max_detector_id + 1, max_element_id + 1)
+        arrays = {field: np.zeros(shape, dtype=np.float64) for field in FLOAT_FIELDS}
+        arrays["plane"] = np.full(shape, -1, dtype=np.int16)
+
+        # planes in order of z
+        plane_ids = sorted(modules, key=lambda detector_id: min(row["z0"] for row in modules[detector_id]))
+        plane_names = [modules[detector_id][0]["det_name"] for detector_id in plane_ids]
+
+        for plane, detector_id in enumerate(plane_ids):
+            angle = np.array([row["angle_from_vert"] + row["theta_z"] for row in modules[detector_id]])
+            centers = np.array([row["x0"] * np.cos(a) + row["y0"] * np.sin(a) for row, a in zip(modules[detector_id], angle)])
+
+            first_element = 1
+            for module in np.argsort(centers, kind="stable"):
+                row = modules[detector_id][module]
+                elements = np.arange(1, row["n_ele"] + 1)
+                cos, sin = np.cos(angle[module]), np.sin(angle[module])
+                position = row["cell_spacing"] * (elements - (row["n_ele"] + 1) / 2) + row["xoffset"] + centers[module]
+
+                index = (detector_id, first_element - 1 + elements)
+                arrays["position"][index] = position
+                arrays["x"][index] = row["x0"] + (position - centers[module]) * cos
+                arrays["y"][index] = row["y0"] + (position - centers[module]) * sin
+                arrays["z"][index] = row["z0"]
+                arrays["cos"][index] = cos
+                arrays["sin"][index] = sin
+                arrays["spacing"][index] = row["cell_spacing"]
+                arrays["cell_width"][index] = row["cell_width"]
+                arrays["plane"][index] = plane
+                first_element += row["n_ele"]
+
+        return cls(arrays, plane_ids, plane_names)
+
+    # Flat lookup index of each hit, plus a mask of the hits that land on a known wire
+    def hit_index(self, detector_ids, element_ids):
+        detector_ids = np.asarray(detector_ids, dtype=np.int64)
+        element_ids = np.asarray(element_ids, dtype=np.int64)
+
+        inside = (detector_ids >= 0) & (detector_ids <= self.max_detector_id) & (element_ids >= 0) & (element_ids <= self.max_element_id)
+        index = np.where(inside, detector_ids * (self.max_element_id + 1) + element_ids, 0)
+        return index, inside & self.valid.reshape(-1)[index]
+
+    # Geometry columns of many hits at once: dict of field -> array, plus "valid"
+    def hit_geometry(self, detector_ids, element_ids, fields=("position", "z", "cos", "sin", "plane")):
+        index, valid = self.hit_index(detector_ids, element_ids)
+        geometry = {field: getattr(self, field).reshape(-1)[index] for field in fields}
+        geometry["valid"] = valid
+        return geometry
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for field in FLOAT_FIELDS + INT_FIELDS:
+            np.save(os.path.join(directory, field + ".npy"), getattr(self, field))
+        np.save(os.path.join(directory, "plane_ids.npy"), np.array(self.plane_ids, dtype=np.int16))
+        np.save(os.path.join(directory, "plane_names.npy"), np.array(self.plane_names))
+
+    @classmethod
+    def load(cls, directory):
+        arrays = {field: np.load(os.path.join(directory, field + ".npy")) for field in FLOAT_FIELDS + INT_FIELDS}
+        plane_ids = [int(detector_id) for detector_id in np.load(os.path.join(directory, "plane_ids.npy"))]
+        plane_names = [str(name) for name in np.load(os.path.join(directory, "plane_names.npy"))]
+        return cls(arrays, plane_ids, plane_names)
+
+# geometry tables loaded so far, keyed by their cache directory
+geometries = dict()
+
+# Get the DetectorGeometry of a spectrometer CSV, computed once and cached as .npy files
+# keyed by the CSV contents
+def load_geometry(file_name=SPECTROMETER_INFO_PATH, cache_dir=GEOMETRY_CACHE_DIR):
+    with open(file_name, 'rb') as infile:
+        digest = hashlib.sha1(infile.read() + str(GEOMETRY_VERSION).encode()).hexdigest()[:16]
+    directory = os.path.join(cache_dir, digest)
+
+    if directory not in geometries:
+        if os.path.exists(os.path.join(directory, "plane.npy")):
+            geometries[directory] = DetectorGeometry.load(directory)
+        else:
+            geometry = DetectorGeometry.from_rows(read_spectrometer_rows(file_name))
+
+            # write into a temporary directory so an interrupted save never looks complete
+            shutil.rmtree(directory + ".tmp", ignore_errors=True)
+            geometry.save(directory + ".tmp")
+            shutil.rmtree(directory, ignore_errors=True)
+            os.rename(directory + ".tmp", directory)
+            geometries[directory] = geometry
+
+    return geometries[directory]
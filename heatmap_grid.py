@@ -0,0 +1,87 @@
+import numpy as np
+from ragged import as_ragged
+
+# Columns of the detector display: every detector that isn't excluded, in spectrometer order.
+# Hidden detectors keep their column (drawn blank) so the axes never change.
+def heatmap_columns(name_to_id_elements, excluded_detector_ids):
+    return [
+        (detector_name, detector_id, num_elements)
+        for detector_name, (detector_id, num_elements, display) in name_to_id_elements.items()
+        if detector_id not in excluded_detector_ids
+    ]
+
+# Display grid of (max_element_id rows) x (one column per detector). Every (detector, element)
+# pair is precomputed to the column and the [row_start, row_stop) span of block_height rows it
+# fills, so an event's grid is a lookup plus one scatter over its hits instead of a loop over
+# detectors and rows.
+class HeatmapGrid:
+    def __init__(self, columns, max_element_id):
+        self.columns = columns
+        self.max_element_id = max_element_id
+        self.num_columns = len(columns)
+
+        max_detector_id = max([detector_id for _, detector_id, _ in columns], default=0)
+        max_num_elements = max([num_elements for _, _, num_elements in columns], default=0)
+
+        # indexed by [detectorID, elementID]; column -1 means the pair isn't drawn
+        self.column = np.full((max_detector_id + 1, max_num_elements + 1), -1, dtype=np.int64)
+        self.row_start = np.zeros(self.column.shape, dtype=np.int64)
+        self.row_stop = np.zeros(self.column.shape, dtype=np.int64)
+
+        for col, (detector_name, detector_id, num_elements) in enumerate(columns):
+            block_height = int(max_element_id / num_elements)
+            element_idxs = np.arange(num_elements)
+            self.column[detector_id, 1:num_elements + 1] = col
+            self.row_start[detector_id, 1:num_elements + 1] = np.minimum(element_idxs * block_height, max_element_id)
+            self.row_stop[detector_id, 1:num_elements + 1] = np.minimum((element_idxs + 1) * block_height, max_element_id)
+
+    # column and row span of each drawn hit, plus a mask of which hits are drawn
+    def hit_spans(self, detector_ids, element_ids):
+        detector_ids = np.asarray(detector_ids, dtype=np.int64)
+        element_ids = np.asarray(element_ids, dtype=np.int64)
+
+        inside = (detector_ids >= 0) & (detector_ids < self.column.shape[0]) & (element_ids >= 0) & (element_ids < self.column.shape[1])
+        columns = np.full(len(detector_ids), -1, dtype=np.int64)
+        columns[inside] = self.column[detector_ids[inside], element_ids[inside]]
+        drawn = columns >= 0
+
+        detector_ids, element_ids = detector_ids[drawn], element_ids[drawn]
+        return drawn, columns[drawn], self.row_start[detector_ids, element_ids], self.row_stop[detector_ids, element_ids]
+
+    # (num_events, max_element_id, num_columns) uint8 grids with 1 where a hit is drawn.
+    # Each hit adds +1 at row_start and -1 at row_stop of its column; a cumulative sum down
+    # the rows then fills every span in one pass.
+    def event_grids(self, detector_events, element_events):
+        detector_events = as_ragged(detector_events)
+        element_events = as_ragged(element_events)
+        num_events = len(detector_events)
+        num_rows = self.max_element_id + 1
+
+        drawn, columns, row_start, row_stop = self.hit_spans(detector_events.flat(), element_events.flat())
+        event_index = detector_events.event_index()[drawn]
+
+        size = num_events * num_rows * self.num_columns
+        starts = (event_index * num_rows + row_start) * self.num_columns + columns
+        stops = (event_index * num_rows + row_stop) * self.num_columns + columns
+        diff = np.bincount(starts, minlength=size) - np.bincount(stops, minlength=size)
+
+        filled = np.cumsum(diff.reshape(num_events, num_rows, self.num_columns), axis=1)[:, :self.max_element_id]
+        return (filled > 0).astype(np.uint8)
+
+    # (max_element_id, num_columns) grid of a single event
+    def event_grid(self, detector_ids, element_ids):
+        detector_ids = np.asarray(detector_ids)
+        element_ids = np.asarray(element_ids)
+        return self.event_grids(detector_ids[np.newaxis], element_ids[np.newaxis])[0]
+
+# grids built so far, keyed by their columns and height
+heatmap_grids = dict()
+
+# Get the HeatmapGrid for a detector layout, building it the first time it's needed
+def get_heatmap_grid(name_to_id_elements, max_element_id, excluded_detector_ids):
+    columns = heatmap_columns(name_to_id_elements, excluded_detector_ids)
+    key = (tuple(columns), max_element_id)
+    if key not in heatmap_grids:
+        heatmap_grids[key] = HeatmapGrid(columns, max_element_id)
+
+    return heatmap_grids[key]
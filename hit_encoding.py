@@ -0,0 +1,121 @@
+import numpy as np
+from ragged import RaggedArray, as_ragged, counts_to_offsets
+
+# CONSTANTS
+HIT_MATRIX_CHUNK_SIZE = 65536  # events scattered per step in convert_to_hit_matrices
+
+# Flat channel id ((detector - 1) * max_element_id + element - 1) of each hit, plus a mask
+# of which hits have ids inside [1, max_detector_id] x [1, max_element_id]
+def hit_channels(detectors, elements, max_detector_id, max_element_id):
+    valid = (detectors >= 1) & (detectors <= max_detector_id) & (elements >= 1) & (elements <= max_element_id)
+    channels = (detectors[valid].astype(np.int64) - 1) * max_element_id + (elements[valid] - 1)
+
+    return valid, channels
+
+# convert detector and element id matrices into hit matrices.
+# Hits are flattened with their event offsets and scattered in one vectorized step per chunk
+# of events into a compact uint8 tensor. Hits whose ids are 0 or beyond max_detector_id /
+# max_element_id (including the 32767 padding slots) are dropped. Pass out to fill a
+# caller-provided buffer instead, e.g. one from np.lib.format.open_memmap for datasets
+# larger than RAM.
+def convert_to_hit_matrices(detector_events, element_events, max_detector_id, max_element_id, out=None, dtype=np.uint8):
+    detector_events = as_ragged(detector_events)
+    element_events = as_ragged(element_events)
+    num_events = len(detector_events)
+
+    if out is None:
+        hit_matrices = np.zeros((num_events, max_detector_id, max_element_id), dtype=dtype)
+    else:
+        if out.shape != (num_events, max_detector_id, max_element_id):
+            raise Exception("Output buffer has shape {}, expected {}.".format(out.shape, (num_events, max_detector_id, max_element_id)))
+        # the hits are written through a flat view, which a strided buffer can't give
+        if not out.flags.c_contiguous:
+            raise Exception("Output buffer must be C-contiguous.")
+        hit_matrices = out
+        hit_matrices[...] = 0
+
+    flat_matrices = hit_matrices.reshape(num_events, max_detector_id * max_element_id)
+    for start in range(0, num_events, HIT_MATRIX_CHUNK_SIZE):
+        stop = min(start + HIT_MATRIX_CHUNK_SIZE, num_events)
+        detectors = detector_events[start:stop].flat()
+        elements = element_events[start:stop].flat()
+        event_index = detector_events[start:stop].event_index() + start
+
+        valid, channels = hit_channels(detectors, elements, max_detector_id, max_element_id)
+        flat_matrices[event_index[valid], channels] = 1
+
+    return hit_matrices
+
+# Hit matrices stored as the list of hit channel ids of each event (CSR over events), so
+# memory scales with the number of hits instead of the ~24k channels of a dense matrix.
+# densify expands only the events that are about to be fed to the model.
+# input_pipeline.chunk_hits encodes every chunk of the tf.data pipeline this way, and
+# save/load keep an encoded data set on disk.
+class SparseHitMatrices:
+    def __init__(self, offsets, channels, max_detector_id, max_element_id):
+        self.hits = RaggedArray(offsets, channels)
+        self.max_detector_id = max_detector_id
+        self.max_element_id = max_element_id
+
+    def __len__(self):
+        return len(self.hits)
+
+    @property
+    def matrix_shape(self):
+        return (self.max_detector_id, self.max_element_id)
+
+    # dense (len(event_indices), max_detector_id, max_element_id) hit matrices for some events
+    def densify(self, event_indices, out=None, dtype=np.uint8):
+        event_indices = np.asarray(event_indices)
+        num_events = len(event_indices)
+        if out is None:
+            out = np.zeros((num_events,) + self.matrix_shape, dtype=dtype)
+        else:
+            if out.shape != (num_events,) + self.matrix_shape:
+                raise Exception("Output buffer has shape {}, expected {}.".format(out.shape, (num_events,) + self.matrix_shape))
+            if not out.flags.c_contiguous:
+                raise Exception("Output buffer must be C-contiguous.")
+            out[...] = 0
+
+        # gather the hits of the requested events without a Python loop
+        starts = self.hits.offsets[event_indices]
+        counts = self.hits.offsets[event_indices + 1] - starts
+        batch_offsets = counts_to_offsets(counts)
+        positions = np.arange(batch_offsets[-1]) + np.repeat(starts - batch_offsets[:-1], counts)
+        batch_index = np.repeat(np.arange(num_events), counts)
+
+        out.reshape(num_events, -1)[batch_index, self.hits.values[positions]] = 1
+
+        return out
+
+    def save(self, file_name):
+        np.savez(file_name, offsets=self.hits.offsets, channels=self.hits.values, matrix_shape=np.array(self.matrix_shape))
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            max_detector_id, max_element_id = data["matrix_shape"]
+            return cls(data["offsets"], data["channels"], int(max_detector_id), int(max_element_id))
+
+# Sparse counterpart of convert_to_hit_matrices, with the same filtering of invalid hits
+def convert_to_sparse_hit_matrices(detector_events, element_events, max_detector_id, max_element_id):
+    detector_events = as_ragged(detector_events)
+    element_events = as_ragged(element_events)
+    num_events = len(detector_events)
+
+    # uint16 is enough for the 62 x 384 spectrometer channels
+    channel_dtype = np.uint16 if max_detector_id * max_element_id <= np.iinfo(np.uint16).max + 1 else np.int32
+    counts = np.zeros(num_events, dtype=np.int64)
+    all_channels = []
+    for start in range(0, num_events, HIT_MATRIX_CHUNK_SIZE):
+        stop = min(start + HIT_MATRIX_CHUNK_SIZE, num_events)
+        detectors = detector_events[start:stop].flat()
+        elements = element_events[start:stop].flat()
+        event_index = detector_events[start:stop].event_index()
+
+        valid, channels = hit_channels(detectors, elements, max_detector_id, max_element_id)
+        counts[start:stop] = np.bincount(event_index[valid], minlength=stop - start)
+        all_channels.append(channels.astype(channel_dtype))
+
+    channels = np.concatenate(all_channels) if len(all_channels) > 0 else np.zeros(0, dtype=channel_dtype)
+    return SparseHitMatrices(counts_to_offsets(counts), channels, max_detector_id, max_element_id)
@@ -0,0 +1,227 @@
+import numpy as np
+from geometry import load_geometry
+from ragged import RaggedArray, as_ragged
+from track_fit import DEFAULT_FIT_STATIONS, fit_lines, station_planes
+
+# CONSTANTS
+HOUGH_BATCH_SIZE = 250  # events per accumulator; bounds the working memory to about 70 MB
+Z_REFERENCE = 1600.0  # z (cm) the x-view intercepts are binned at, between D2 and D3
+# x view: lines x = x0 + tx * (z - Z_REFERENCE)
+X_SLOPE_RANGE = (-0.2, 0.2)
+X_SLOPE_BINS = 80
+X_INTERCEPT_RANGE = (-200.0, 200.0)
+X_INTERCEPT_BINS = 200
+# y view: lines y = y0 + ty * z. Neither magnet bends in y, so tracks point back to the
+# target and y0 stays within a few tens of cm; this is what rules out ghost lines joining the
+# D2 hits of one track to the D3 hits of another.
+Y_SLOPE_RANGE = (-0.1, 0.1)
+Y_SLOPE_BINS = 40
+Y_INTERCEPT_RANGE = (-40.0, 40.0)
+Y_INTERCEPT_BINS = 10
+X_CANDIDATES_PER_TRACK = 3  # x lines kept per expected track before the stereo views pick the best
+MIN_PLANES = 4  # fewest distinct planes a candidate needs
+PEAK_SUPPRESSION = (2, 2)  # (slope, intercept) bins cleared around a peak before the next one
+ASSIGN_WINDOW = 3.0  # largest hit residual, in cell spacings, for a hit to join a candidate
+REFIT_ITERATIONS = 1  # least-squares refits of the candidates to their hits before the final assignment
+STEREO_SIN = 0.1  # planes with |sin| of their angle below this are x views
+
+# Hough accumulator of straight lines value = intercept + slope * (z - z_ref) per group of hits.
+# Only the wire of a hit is known, not where in the cell the track passed, so every hit votes,
+# once per slope bin, for all the intercept bins within half_width of its line. The votes of
+# one plane are added with a single buffered fancy-index increment, so each cell counts how
+# many distinct planes have a hit on the line. Returns a (num_groups, slope_bins,
+# intercept_bins) uint8 array plus the slope and intercept bin centers.
+def hough_accumulate(group, plane, z, value, half_width, num_groups, slope_range, slope_bins, intercept_range, intercept_bins, z_ref=Z_REFERENCE):
+    slopes = np.linspace(slope_range[0], slope_range[1], slope_bins)
+    intercept_width = (intercept_range[1] - intercept_range[0]) / intercept_bins
+    accumulator = np.zeros(num_groups * slope_bins * intercept_bins, dtype=np.uint8)
+
+    # (hits, slopes) ranges of intercept bins, with the hits sorted by plane
+    order = np.argsort(plane, kind="stable")
+    group, plane, z, value, half_width = group[order], plane[order], z[order], value[order], half_width[order]
+    intercepts = value[:, np.newaxis] - slopes[np.newaxis, :] * (z[:, np.newaxis] - z_ref)
+    first = np.floor((intercepts - half_width[:, np.newaxis] - intercept_range[0]) / intercept_width).astype(np.int64)
+    last = np.floor((intercepts + half_width[:, np.newaxis] - intercept_range[0]) / intercept_width).astype(np.int64)
+    np.clip(first, 0, None, out=first)
+    np.clip(last, None, intercept_bins - 1, out=last)
+    cells = (group[:, np.newaxis] * slope_bins + np.arange(slope_bins)[np.newaxis, :]) * intercept_bins + first
+    span = last - first
+
+    plane_starts = np.flatnonzero(np.diff(plane, prepend=-1, append=-1))
+    for start, stop in zip(plane_starts[:-1], plane_starts[1:]):
+        plane_cells, plane_span = cells[start:stop], span[start:stop]
+        # (a negative span means the line leaves the intercept range)
+        if plane_span.max() >= 0:
+            accumulator[np.concatenate([plane_cells[plane_span >= k] + k for k in range(int(plane_span.max()) + 1)])] += 1
+
+    return accumulator.reshape(num_groups, slope_bins, intercept_bins), slopes, intercept_range[0] + intercept_width * (np.arange(intercept_bins) + 0.5)
+
+# Take up to max_peaks[g] peaks of every group's accumulator, highest first, clearing the
+# cells around each peak before looking for the next. Returns (group, slope, intercept, votes)
+# arrays of the peaks with at least min_votes votes.
+def hough_peaks(accumulator, max_peaks, min_votes=MIN_PLANES, suppression=PEAK_SUPPRESSION):
+    accumulator = accumulator.copy()
+    num_groups, slope_bins, intercept_bins = accumulator.shape
+    flat = accumulator.reshape(num_groups, slope_bins * intercept_bins)
+    max_peaks = np.broadcast_to(np.asarray(max_peaks), (num_groups,))
+
+    window_slopes, window_intercepts = np.meshgrid(np.arange(-suppression[0], suppression[0] + 1), np.arange(-suppression[1], suppression[1] + 1), indexing="ij")
+    groups, slope_indices, intercept_indices, votes = [], [], [], []
+    for peak in range(int(max_peaks.max()) if num_groups > 0 else 0):
+        best = flat.argmax(axis=1)
+        best_votes = flat[np.arange(num_groups), best]
+        found = (best_votes >= min_votes) & (peak < max_peaks)
+
+        slope_index, intercept_index = np.divmod(best[found], intercept_bins)
+        groups.append(np.nonzero(found)[0])
+        slope_indices.append(slope_index)
+        intercept_indices.append(intercept_index)
+        votes.append(best_votes[found].astype(np.int64))
+
+        # clear the neighbourhood of each peak
+        window_slope = np.clip(slope_index[:, np.newaxis] + window_slopes.ravel(), 0, slope_bins - 1)
+        window_intercept = np.clip(intercept_index[:, np.newaxis] + window_intercepts.ravel(), 0, intercept_bins - 1)
+        accumulator[np.nonzero(found)[0][:, np.newaxis], window_slope, window_intercept] = 0
+
+    order = np.argsort(np.concatenate(groups), kind="stable") if len(groups) > 0 else np.zeros(0, dtype=np.int64)
+    return tuple(np.concatenate(arrays)[order] if len(arrays) > 0 else np.zeros(0, dtype=np.int64) for arrays in (groups, slope_indices, intercept_indices, votes))
+
+# Find up to max_tracks straight track candidates per event in batches of events.
+# 1. x-view hits of every event vote in an (x slope, x intercept) Hough accumulator; its
+#    peaks are the candidates.
+# 2. For each candidate, the stereo (U/V) hits of its event are turned into y estimates
+#    y = (u - cos * x(z)) / sin and vote in a (y slope, y intercept) accumulator; its peak
+#    gives the candidate's y line.
+#    The max_tracks candidates of each event with the most votes over both views are kept.
+# 3. Every hit joins the candidate of its event with the smallest residual, if that residual
+#    is within ASSIGN_WINDOW cell spacings; the candidates are then refitted to their hits
+#    with track_fit.fit_lines and the hits assigned again.
+# max_tracks is an int or one count per event (e.g. the n_tracks branch). Returns the per-hit
+# labels as a RaggedArray with the offsets of the hits (-1 for unassigned hits), ready for
+# track_fit.fit_events, plus a dict of per-candidate arrays (event, label, x0, tx, y0, ty at
+# z = 0, votes).
+def find_tracks(detector_events, element_events, max_tracks=2, geometry=None, stations=DEFAULT_FIT_STATIONS, batch_size=HOUGH_BATCH_SIZE):
+    geometry = geometry if geometry is not None else load_geometry()
+    detector_events = as_ragged(detector_events)
+    element_events = as_ragged(element_events)
+    num_events = len(detector_events)
+    max_tracks = np.broadcast_to(np.asarray(max_tracks, dtype=np.int64), (num_events,))
+    planes = station_planes(geometry, stations)
+
+    labels = np.full(len(detector_events.flat()), -1, dtype=np.int64)
+    candidates = {field: [] for field in ("event", "label", "x0", "tx", "y0", "ty", "votes")}
+    for start in range(0, num_events, batch_size):
+        stop = min(start + batch_size, num_events)
+        hit_start, hit_stop = detector_events.offsets[start] - detector_events.offsets[0], detector_events.offsets[stop] - detector_events.offsets[0]
+        batch_labels, batch_candidates = _find_batch_tracks(
+            detector_events[start:stop], element_events[start:stop], max_tracks[start:stop], geometry, planes)
+
+        labels[hit_start:hit_stop] = batch_labels
+        batch_candidates["event"] += start
+        for field in candidates:
+            candidates[field].append(batch_candidates[field])
+
+    candidates = {field: np.concatenate(arrays) if len(arrays) > 0 else np.zeros(0) for field, arrays in candidates.items()}
+    return RaggedArray(detector_events.offsets - detector_events.offsets[0], labels), candidates
+
+# Candidate (index into the parameter arrays, lines at z = 0) of each of the hits used_hits:
+# the candidate of the hit's event with the smallest residual, or -1 if no candidate of the
+# event comes within ASSIGN_WINDOW cell spacings
+def _assign_hits(hits, used_hits, event_index, table, x0, tx, y0, ty):
+    if table.shape[1] == 0 or len(used_hits) == 0:
+        return np.full(len(used_hits), -1, dtype=np.int64)
+
+    hit_candidates = table[event_index[used_hits]]
+    safe = np.maximum(hit_candidates, 0)
+    z = hits["z"][used_hits][:, np.newaxis]
+    predicted = hits["cos"][used_hits][:, np.newaxis] * (x0[safe] + tx[safe] * z) + hits["sin"][used_hits][:, np.newaxis] * (y0[safe] + ty[safe] * z)
+    residual = np.abs(hits["position"][used_hits][:, np.newaxis] - predicted)
+    residual[hit_candidates < 0] = np.inf
+
+    closest = residual.argmin(axis=1)
+    close_enough = residual[np.arange(len(used_hits)), closest] <= ASSIGN_WINDOW * hits["spacing"][used_hits]
+    return np.where(close_enough, hit_candidates[np.arange(len(used_hits)), closest], -1)
+
+# Per-event table (events, most candidates of an event) of candidate indices, -1 where an
+# event has fewer, plus each candidate's index within its event. candidate_event is sorted.
+def _candidate_table(candidate_event, num_events):
+    first_candidate = np.searchsorted(candidate_event, np.arange(num_events))
+    label = np.arange(len(candidate_event)) - first_candidate[candidate_event]
+    table = np.full((num_events, int(label.max()) + 1 if len(label) > 0 else 0), -1, dtype=np.int64)
+    table[candidate_event, label] = np.arange(len(candidate_event))
+    return table, label
+
+# find_tracks on one batch of events
+def _find_batch_tracks(detector_events, element_events, max_tracks, geometry, planes):
+    num_events = len(detector_events)
+    hits = geometry.hit_geometry(detector_events.flat(), element_events.flat(), ("position", "z", "cos", "sin", "spacing", "plane"))
+    event_index = detector_events.event_index()
+    used = hits["valid"] & np.isin(hits["plane"], planes)
+    x_view = used & (np.abs(hits["sin"]) < STEREO_SIN)
+    stereo_view = used & ~x_view
+
+    # 1. x lines per event (x-view planes measure u = x * cos, cos close to 1). With only two
+    #    stations behind the magnet, the x hits of two tracks also line up into ghost lines,
+    #    so extra x candidates are kept until the stereo views have had their say.
+    accumulator, slopes, intercepts = hough_accumulate(
+        event_index[x_view], hits["plane"][x_view], hits["z"][x_view], hits["position"][x_view] / hits["cos"][x_view],
+        hits["spacing"][x_view] / 2, num_events, X_SLOPE_RANGE, X_SLOPE_BINS, X_INTERCEPT_RANGE, X_INTERCEPT_BINS)
+    candidate_event, slope_index, intercept_index, votes = hough_peaks(accumulator, max_tracks * X_CANDIDATES_PER_TRACK)
+    tx, x_ref = slopes[slope_index], intercepts[intercept_index]
+    table, _ = _candidate_table(candidate_event, num_events)
+
+    # 2. y lines per candidate from the stereo hits of its event
+    stereo_hits = np.nonzero(stereo_view)[0]
+    pair_hit = np.repeat(stereo_hits, table.shape[1])
+    pair_candidate = table[event_index[stereo_hits]].ravel()
+    pair_hit, pair_candidate = pair_hit[pair_candidate >= 0], pair_candidate[pair_candidate >= 0]
+    z = hits["z"][pair_hit]
+    x = x_ref[pair_candidate] + tx[pair_candidate] * (z - Z_REFERENCE)
+    y = (hits["position"][pair_hit] - hits["cos"][pair_hit] * x) / hits["sin"][pair_hit]
+
+    accumulator, slopes, intercepts = hough_accumulate(
+        pair_candidate, hits["plane"][pair_hit], z, y, hits["spacing"][pair_hit] / 2 / np.abs(hits["sin"][pair_hit]), len(candidate_event),
+        Y_SLOPE_RANGE, Y_SLOPE_BINS, Y_INTERCEPT_RANGE, Y_INTERCEPT_BINS, z_ref=0.0)
+    y_candidate, slope_index, intercept_index, y_votes = hough_peaks(accumulator, 1)
+    ty, y0 = np.zeros(len(candidate_event)), np.zeros(len(candidate_event))
+    ty[y_candidate], y0[y_candidate] = slopes[slope_index], intercepts[intercept_index]
+    votes[y_candidate] += y_votes
+
+    # keep the max_tracks candidates of each event with the most planes on their x and y lines
+    order = y_candidate[np.lexsort((-votes[y_candidate], candidate_event[y_candidate]))]
+    _, rank = _candidate_table(candidate_event[order], num_events)
+    kept = np.sort(order[rank < max_tracks[candidate_event[order]]])
+    candidate_event, tx, x_ref, ty, y0, votes = [array[kept] for array in (candidate_event, tx, x_ref, ty, y0, votes)]
+    table, label = _candidate_table(candidate_event, num_events)
+
+    x0 = x_ref - tx * Z_REFERENCE
+
+    # 3. assign every used hit to the closest candidate of its event, then refit each
+    #    candidate to its hits and assign again with the fitted lines
+    used_hits = np.nonzero(used)[0]
+    hit_candidate = _assign_hits(hits, used_hits, event_index, table, x0, tx, y0, ty)
+    for iteration in range(REFIT_ITERATIONS):
+        group = np.full(len(event_index), -1, dtype=np.int64)
+        group[used_hits] = hit_candidate
+        weight = np.zeros(len(event_index))
+        weight[used_hits] = 12 / hits["spacing"][used_hits] ** 2
+        fit = fit_lines(hits["position"], hits["z"], hits["cos"], hits["sin"], weight, group, len(candidate_event))
+
+        fitted = fit["valid"]
+        for parameters, fitted_parameters in zip((x0, tx, y0, ty), (fit["x0"], fit["tx"], fit["y0"], fit["ty"])):
+            parameters[fitted] = fitted_parameters[fitted]
+        hit_candidate = _assign_hits(hits, used_hits, event_index, table, x0, tx, y0, ty)
+
+    labels = np.full(len(event_index), -1, dtype=np.int64)
+    assigned = hit_candidate >= 0
+    labels[used_hits[assigned]] = label[hit_candidate[assigned]]
+
+    return labels, {
+        "event": candidate_event,
+        "label": label,
+        "x0": x0,
+        "tx": tx,
+        "y0": y0,
+        "ty": ty,
+        "votes": votes,
+    }
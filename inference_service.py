@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import Future
+from file_read import get_detector_info
+from event_cache import CACHE_DIR, cache_path, open_cache
+from hit_encoding import convert_to_hit_matrices
+from clustering import encode_hits, load_model_encoding
+from numpy_inference import COMPUTE_DTYPES, WEIGHT_DTYPES, NumpyModel
+
+# CONSTANTS
+SPECTROMETER_INFO_PATH = "spectrometer.csv"
+MODEL_PATH = "models/hit_to_momentum_model.keras"
+OUTPUT_DIR = "predictions"
+MAX_BATCH_SIZE = 256  # most events scored per model call
+MAX_WAIT = 0.005  # seconds the first event of a batch waits for more events to arrive
+LATENCY_WINDOW = 100000  # most recent event latencies kept for the percentiles
+REPORT_INTERVAL = 10.0  # seconds between throughput/latency reports
+
+# Predicted momenta written per ROOT file: one (num_events, outputs) float32 .npy per file,
+# named like the event cache directory of the file, plus an index.json of file -> .npy
+class PredictionStore:
+    def __init__(self, directory=OUTPUT_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, file_path):
+        return cache_path(file_path, self.directory) + ".npy"
+
+    def write(self, file_path, predictions):
+        path = self.path(file_path)
+        with open(path + ".tmp", "wb") as outfile:
+            np.save(outfile, predictions)
+        os.replace(path + ".tmp", path)
+
+        # record the file in the index, rewritten whole so readers never see it half written
+        with self._lock:
+            index_path = os.path.join(self.directory, "index.json")
+            index = dict()
+            if os.path.exists(index_path):
+                with open(index_path, "r") as infile:
+                    index = json.load(infile)
+            index[os.path.abspath(file_path)] = {"predictions": os.path.abspath(path), "num_events": len(predictions)}
+            with open(index_path + ".tmp", "w") as outfile:
+                json.dump(index, outfile, indent=4)
+            os.replace(index_path + ".tmp", index_path)
+
+        return path
+
+# Event latencies (submit to result) and batch sizes, for throughput and p50/p99 reports
+class LatencyStats:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.num_events = 0
+        self.num_batches = 0
+        self.start_time = time.time()
+        self._lock = threading.Lock()
+
+    def record(self, latencies):
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.num_events += len(latencies)
+            self.num_batches += 1
+
+    def report(self):
+        with self._lock:
+            elapsed = max(time.time() - self.start_time, 1e-9)
+            if len(self.latencies) == 0:
+                return "No events scored yet"
+            p50, p99 = np.percentile(np.array(self.latencies), [50, 99]) * 1000
+            return "{} events in {} batches ({:.1f} events/batch), {:.0f} events/s, latency p50 {:.2f} ms, p99 {:.2f} ms".format(
+                self.num_events, self.num_batches, self.num_events / self.num_batches, self.num_events / elapsed, p50, p99)
+
+# Long-lived inference service for the hit -> momentum model. The model is loaded once;
+# events submitted from any thread are queued and a single worker thread groups them into
+# micro-batches, closing a batch when it reaches max_batch_size events or when its first
+# event has waited max_wait seconds, whichever comes first. Each batch is encoded into a
+# reused hit matrix buffer and scored with one predict_on_batch call.
+class InferenceService:
+    def __init__(self, model_path=MODEL_PATH, max_detector_id=None, max_element_id=None,
+                 max_batch_size=MAX_BATCH_SIZE, max_wait=MAX_WAIT, store=None, cache_dir=CACHE_DIR, tree_name=None,
+                 numpy_dtype="float32", numpy_weight_dtype=None):
+        if max_detector_id is None or max_element_id is None:
+            detector_name_to_id_elements = get_detector_info(SPECTROMETER_INFO_PATH)
+            max_detector_id = max([detector_name_to_id_elements[name][0] for name in detector_name_to_id_elements])
+            max_element_id = max([detector_name_to_id_elements[name][1] for name in detector_name_to_id_elements])
+
+        self.max_detector_id = max_detector_id
+        self.max_element_id = max_element_id
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.store = store if store is not None else PredictionStore()
+        self.cache_dir = cache_dir
+        self.tree_name = tree_name
+
+        # .npz exports run on the NumPy engine without importing TensorFlow, computing in
+        # numpy_dtype and, if numpy_weight_dtype is given, with the weights re-quantized to it
+        print("Loading model...")
+        if model_path.endswith(".npz"):
+            self.model = NumpyModel.load(model_path, numpy_dtype, numpy_weight_dtype)
+        else:
+            import tensorflow as tf
+            self.model = tf.keras.models.load_model(model_path)
+        # hits are clustered the same way as when the model was trained
+        self.cluster = load_model_encoding(model_path)["cluster_hits"]
+        self._hit_matrices = np.zeros((max_batch_size, max_detector_id, max_element_id), dtype=np.float32)
+        # first call builds the graph; keep that out of the latencies
+        self.model.predict_on_batch(self._hit_matrices[:1])
+        self.stats = LatencyStats()
+
+        self._requests = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    # Queue one event; the returned Future resolves to its predicted momenta
+    def submit(self, detector_ids, element_ids):
+        future = Future()
+        self._requests.put((time.perf_counter(), detector_ids, element_ids, future))
+        return future
+
+    # Queue every event of a ROOT file (read through the event cache). The returned Future
+    # resolves to the path its predictions were written to in the store. A file that isn't
+    # cached yet has its tree and branches resolved without prompting (as in watch_data),
+    # since nobody is there to answer; an ambiguous one raises unless tree_name was given.
+    def submit_file(self, file_path):
+        columns = open_cache(file_path, self.cache_dir, self.tree_name, interactive=False)
+        detector_events, element_events = columns["detectorID"], columns["elementID"]
+        num_events = len(detector_events)
+
+        file_future = Future()
+        if num_events == 0:
+            file_future.set_result(self.store.write(file_path, np.zeros((0, self.model.output_shape[-1]), dtype=np.float32)))
+            return file_future
+
+        event_futures = [self.submit(detector_events[i], element_events[i]) for i in range(num_events)]
+        remaining = [num_events]
+        remaining_lock = threading.Lock()
+
+        # write the file's predictions once its last event has been scored
+        def event_done(_):
+            with remaining_lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                predictions = np.stack([future.result() for future in event_futures])
+                file_future.set_result(self.store.write(file_path, predictions))
+            except Exception as error:
+                file_future.set_exception(error)
+
+        for future in event_futures:
+            future.add_done_callback(event_done)
+
+        return file_future
+
+    # Collect the next micro-batch: block for its first request, then take more until the
+    # batch is full or the first request has waited max_wait
+    def _next_batch(self):
+        batch = [self._requests.get()]
+        if batch[0] is None:
+            return None
+        deadline = time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self._requests.get(timeout=timeout) if timeout > 0 else self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # finish this batch, then stop
+                self._requests.put(None)
+                break
+            batch.append(request)
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+
+            submit_times = [request[0] for request in batch]
+            futures = [request[3] for request in batch]
+            try:
+                detector_events, element_events = encode_hits([request[1] for request in batch], [request[2] for request in batch], self.cluster)
+                hit_matrices = convert_to_hit_matrices(
+                    detector_events,
+                    element_events,
+                    self.max_detector_id,
+                    self.max_element_id,
+                    out=self._hit_matrices[:len(batch)]
+                )
+                predictions = np.asarray(self.model.predict_on_batch(hit_matrices))
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+                continue
+
+            done_time = time.perf_counter()
+            self.stats.record([done_time - submit_time for submit_time in submit_times])
+            for future, prediction in zip(futures, predictions):
+                future.set_result(prediction)
+
+    # Score whatever is still queued, then stop the worker
+    def stop(self):
+        self._requests.put(None)
+        self._worker.join()
+
+if __name__ == "__main__":
+    # choose what to score and how to batch it
+    parser = argparse.ArgumentParser(description="Online momentum inference with micro-batching")
+    parser.add_argument("files", nargs="*", help="ROOT files to score")
+    parser.add_argument("--watch", help="also score ROOT files as they finish writing in this directory")
+    parser.add_argument("--model", default=MODEL_PATH, help="Keras model to serve, or an .npz from numpy_inference.py")
+    parser.add_argument("--numpy-dtype", choices=COMPUTE_DTYPES, default="float32", help="compute dtype of an .npz model")
+    parser.add_argument("--numpy-weight-dtype", choices=WEIGHT_DTYPES, help="weight precision of an .npz model (default: as exported)")
+    parser.add_argument("--output-dir", default=OUTPUT_DIR, help="where predicted momenta are written")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="event cache directory")
+    parser.add_argument("--tree", help="tree holding the hits (detected automatically if omitted)")
+    parser.add_argument("--max-batch-size", type=int, default=MAX_BATCH_SIZE, help="most events per model call")
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT * 1000, help="longest wait for a batch to fill, in ms")
+    args = parser.parse_args()
+
+    service = InferenceService(args.model, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000,
+                               store=PredictionStore(args.output_dir), cache_dir=args.cache_dir, tree_name=args.tree,
+                               numpy_dtype=args.numpy_dtype, numpy_weight_dtype=args.numpy_weight_dtype)
+
+    # score the files given on the command line
+    for file_path, file_future in [(file_path, service.submit_file(file_path)) for file_path in args.files]:
+        print("Wrote predictions for {} to {}".format(file_path, file_future.result()))
+    if len(args.files) > 0:
+        print(service.stats.report())
+
+    if args.watch is not None:
+        from watchdog.observers import Observer
+        from watch_data import IngestService, Handler
+
+        # converted files go straight to the inference queue
+        def score_file(file_path, directory):
+            service.submit_file(file_path).add_done_callback(
+                lambda future: print("Wrote predictions for {} to {}".format(file_path, future.result())))
+
+        ingest_service = IngestService(args.cache_dir, tree_name=args.tree, on_converted=score_file)
+        observer = Observer()
+        observer.schedule(Handler(ingest_service), args.watch, recursive=True)
+        observer.start()
+
+        # main loop, reporting throughput and latency as we go
+        try:
+            while observer.is_alive():
+                observer.join(REPORT_INTERVAL)
+                print(service.stats.report())
+        finally:
+            observer.stop()
+            observer.join()
+            ingest_service.stop()
+
+    service.stop()
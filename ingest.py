@@ -0,0 +1,72 @@
+import numpy as np
+import uproot
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from file_read import resolve_schema
+from event_cache import CACHE_DIR, HIT_BRANCHES, cache_path, build_cache, open_cache, read_cache_meta
+from ragged import RaggedArray, concatenate_ragged
+
+# Worker: decode one ROOT file into the on-disk event cache. Only the cache directory
+# name goes back to the parent process; the arrays themselves are shared through the
+# memory-mapped .npy files instead of being pickled. The tree and branches were resolved
+# by the parent, and nobody could answer a prompt here anyway.
+def _convert_file(file_path, cache_dir, tree_name, branch_names=None):
+    return build_cache(file_path, cache_dir, tree_name, branch_names=branch_names, interactive=False)
+
+# Decode many ROOT files in parallel and return their columns in the order of file_paths.
+# Each entry of the returned list is the dict returned by event_cache.open_cache.
+def ingest_files(file_paths, max_workers=None, cache_dir=CACHE_DIR):
+    start_time = time.time()
+
+    # resolve trees and branches up front so worker processes never have to prompt
+    to_convert = []
+    for file_path in file_paths:
+        if os.path.exists(os.path.join(cache_path(file_path, cache_dir), "meta.json")):
+            continue
+        with uproot.open(file_path) as file:
+            tree_name, branch_names = resolve_schema(file, HIT_BRANCHES)
+        to_convert.append((file_path, tree_name, branch_names))
+
+    if len(to_convert) > 0:
+        print("Converting {} of {} files with {} workers...".format(len(to_convert), len(file_paths), max_workers or os.cpu_count()))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            converted = executor.map(
+                _convert_file,
+                [file_path for file_path, _, _ in to_convert],
+                [cache_dir] * len(to_convert),
+                [tree_name for _, tree_name, _ in to_convert],
+                [branch_names for _, _, branch_names in to_convert],
+            )
+            for file_path, directory in zip([file_path for file_path, _, _ in to_convert], converted):
+                print("Converted {} -> {}".format(file_path, directory))
+
+    all_columns = [open_cache(file_path, cache_dir) for file_path in file_paths]
+
+    # report throughput of the files decoded in this call; cached files cost no decoding
+    elapsed = max(time.time() - start_time, 1e-9)
+    converted_paths = [file_path for file_path, _, _ in to_convert]
+    cached_paths = [file_path for file_path in file_paths if file_path not in converted_paths]
+    if len(converted_paths) > 0:
+        num_events = sum(read_cache_meta(cache_path(file_path, cache_dir))["num_events"] for file_path in converted_paths)
+        num_megabytes = sum(os.path.getsize(file_path) for file_path in converted_paths) / 1e6
+        print("Converted {} events from {} files in {:.2f} s ({:.0f} events/s, {:.1f} MB/s)".format(
+            num_events, len(converted_paths), elapsed, num_events / elapsed, num_megabytes / elapsed))
+    if len(cached_paths) > 0:
+        num_cached_events = sum(read_cache_meta(cache_path(file_path, cache_dir))["num_events"] for file_path in cached_paths)
+        print("Read {} events from {} already cached files".format(num_cached_events, len(cached_paths)))
+
+    return all_columns
+
+# Join the per-file columns returned by ingest_files into one dict of columns
+def merge_columns(all_columns):
+    branches = [branch for branch in all_columns[0] if all(branch in columns for columns in all_columns)]
+
+    merged = dict()
+    for branch in branches:
+        if isinstance(all_columns[0][branch], RaggedArray):
+            merged[branch] = concatenate_ragged([columns[branch] for columns in all_columns])
+        else:
+            merged[branch] = np.concatenate([columns[branch] for columns in all_columns])
+
+    return merged
@@ -0,0 +1,117 @@
+import numpy as np
+import tensorflow as tf
+import uproot
+from clustering import encode_hits
+from file_read import iter_events, resolve_schema, DEFAULT_STEP_SIZE
+from event_cache import HIT_BRANCHES
+from hit_encoding import convert_to_sparse_hit_matrices
+from ingest import ingest_files
+from labels import join_momentum_arrays
+
+# CONSTANTS
+MOMENTUM_BRANCHES = ["gpx", "gpy", "gpz"]
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_SHUFFLE_BUFFER = 10000
+
+# Encode a chunk of events into (hit channel ids, hits per event) for the dataset: the
+# SparseHitMatrices of the chunk, which the map stage densifies one batch at a time.
+# With unique set, repeated hits on a channel within an event are kept once (sorted by
+# channel), matching the 0/1 hit matrices.
+def chunk_hits(detector_events, element_events, max_detector_id, max_element_id, unique=False):
+    hits = convert_to_sparse_hit_matrices(detector_events, element_events, max_detector_id, max_element_id).hits
+    channels = hits.values.astype(np.int64)
+    row_lengths = hits.counts()
+    if unique:
+        num_channels = max_detector_id * max_element_id
+        keys = np.unique(hits.event_index() * num_channels + channels)
+        event_index, channels = keys // num_channels, keys % num_channels
+        row_lengths = np.bincount(event_index, minlength=len(hits))
+
+    return channels.astype(np.int32), row_lengths.astype(np.int64)
+
+# Build a tf.data.Dataset of (hit matrix batch, label batch) read straight from ROOT files.
+# Events are read in chunks of step_size, turned into hit channel lists, shuffled through a
+# bounded buffer, batched, densified into create_model's (max_detector_id, max_element_id)
+# input in parallel map calls and prefetched, so datasets larger than RAM train unchanged.
+# With cache_dir the files are first converted in parallel to the on-disk event cache and
+# every epoch reads the memory-mapped arrays instead of decompressing the ROOT files again.
+# Without shuffling, events come out in file order so predictions line up with the files.
+# With sparse_inputs, batches hold each event's unique hit channel ids instead, padded with -1
+# to the longest event of the batch (the input of reconstruct.create_sparse_model).
+# With cluster, hits on adjacent wires are merged by clustering.cluster_hits first and each
+# cluster enters as the single wire nearest its centroid.
+def build_dataset(file_paths, max_detector_id, max_element_id, batch_size=DEFAULT_BATCH_SIZE, shuffle=True,
+                  shuffle_buffer=DEFAULT_SHUFFLE_BUFFER, with_labels=True, step_size=DEFAULT_STEP_SIZE,
+                  cache_dir=None, max_workers=None, parallel_files=4, sparse_inputs=False, cluster=False):
+    branches = HIT_BRANCHES + (MOMENTUM_BRANCHES if with_labels else [])
+
+    if cache_dir is not None:
+        file_columns = dict(zip(file_paths, ingest_files(file_paths, max_workers, cache_dir)))
+
+        def read_chunks(file_path):
+            columns = file_columns[file_path]
+            for start in range(0, len(columns["detectorID"]), step_size):
+                yield {branch: columns[branch][start:start + step_size] for branch in branches}
+    else:
+        # resolve trees/branches here so the generator threads never prompt
+        resolutions = dict()
+        for file_path in file_paths:
+            with uproot.open(file_path) as file:
+                resolutions[file_path] = resolve_schema(file, branches)
+
+        def read_chunks(file_path):
+            tree_name, resolved_branches = resolutions[file_path]
+            yield from iter_events(file_path, branches, step_size, tree_name, resolved_branches)
+
+    def generate(file_path):
+        for chunk in read_chunks(file_path.decode()):
+            detector_events, element_events = encode_hits(chunk["detectorID"], chunk["elementID"], cluster)
+            channels, row_lengths = chunk_hits(detector_events, element_events, max_detector_id, max_element_id, unique=sparse_inputs)
+            if with_labels:
+                yield channels, row_lengths, join_momentum_arrays(chunk["gpx"], chunk["gpy"], chunk["gpz"])
+            else:
+                yield channels, row_lengths
+
+    output_signature = (
+        tf.TensorSpec(shape=[None], dtype=tf.int32),
+        tf.TensorSpec(shape=[None], dtype=tf.int64),
+    )
+    if with_labels:
+        output_signature += (tf.TensorSpec(shape=[None, None], dtype=tf.float32),)
+
+    # read several files at once when the order doesn't matter
+    cycle_length = parallel_files if shuffle else 1
+    dataset = tf.data.Dataset.from_tensor_slices(list(file_paths)).interleave(
+        lambda file_path: tf.data.Dataset.from_generator(generate, args=(file_path,), output_signature=output_signature),
+        cycle_length=cycle_length,
+        num_parallel_calls=cycle_length,
+        deterministic=not shuffle,
+    )
+
+    # split chunks into single events: a variable-length channel list (+ label) each
+    dataset = dataset.map(lambda channels, row_lengths, *labels: (tf.RaggedTensor.from_row_lengths(channels, row_lengths),) + labels)
+    dataset = dataset.unbatch()
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.ragged_batch(batch_size)
+
+    num_channels = max_detector_id * max_element_id
+
+    def densify(channels, *labels):
+        num_events = tf.cast(channels.nrows(), tf.int64)
+        indices = tf.stack([channels.value_rowids(), tf.cast(channels.values, tf.int64)], axis=1)
+        dense = tf.scatter_nd(indices, tf.ones_like(channels.values, dtype=tf.float32), tf.stack([num_events, num_channels]))
+        hit_matrices = tf.reshape(tf.minimum(dense, 1.0), [-1, max_detector_id, max_element_id])
+        if len(labels) == 0:
+            return hit_matrices
+        # ragged_batch also batches the labels as ragged; they all have the same length
+        return hit_matrices, labels[0].to_tensor()
+
+    def pad(channels, *labels):
+        padded_channels = channels.to_tensor(default_value=-1)
+        if len(labels) == 0:
+            return padded_channels
+        return padded_channels, labels[0].to_tensor()
+
+    dataset = dataset.map(pad if sparse_inputs else densify, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
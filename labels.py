@@ -0,0 +1,55 @@
+import numpy as np
+from ragged import flatten_events
+
+# CONSTANTS
+# muon mass in GeV, used to compute track energies
+MUON_MASS = 0.10566
+
+# Turn ragged per-track truth momenta into a fixed (N, max_tracks, 3) float32 tensor of
+# [px, py, pz] (or (N, max_tracks, 4) with E appended when with_energy is set) plus an
+# (N, max_tracks) mask of which slots hold a real track. Built from the event offsets in a
+# few vectorized steps, with no per-event Python work. Tracks past max_tracks are dropped;
+# by default max_tracks is the largest track count of any event.
+def build_track_labels(gpx, gpy, gpz, max_tracks=None, with_energy=False, mass=MUON_MASS):
+    counts, px = flatten_events(gpx)
+    py_counts, py = flatten_events(gpy)
+    pz_counts, pz = flatten_events(gpz)
+    if not (np.array_equal(counts, py_counts) and np.array_equal(counts, pz_counts)):
+        raise Exception("gpx, gpy and gpz have different numbers of tracks.")
+
+    num_events = len(counts)
+    if max_tracks is None:
+        max_tracks = int(counts.max()) if num_events > 0 else 0
+
+    # slot of each track inside its event
+    event_index = np.repeat(np.arange(num_events), counts)
+    starts = np.repeat(np.cumsum(counts) - counts, counts)
+    track_index = np.arange(len(event_index)) - starts
+    keep = track_index < max_tracks
+    event_index, track_index = event_index[keep], track_index[keep]
+
+    num_components = 4 if with_energy else 3
+    labels = np.zeros((num_events, max_tracks, num_components), dtype=np.float32)
+    labels[event_index, track_index, 0] = px[keep]
+    labels[event_index, track_index, 1] = py[keep]
+    labels[event_index, track_index, 2] = pz[keep]
+
+    mask = np.zeros((num_events, max_tracks), dtype=bool)
+    mask[event_index, track_index] = True
+
+    if with_energy:
+        # E^2 = p^2 + m^2
+        momenta = labels[..., :3].astype(np.float64)
+        energy = np.sqrt((momenta ** 2).sum(axis=-1) + mass ** 2)
+        labels[..., 3] = np.where(mask, energy, 0)
+
+    return labels, mask
+
+# Labels laid out as [px..., py..., pz...] per event, for events that all have the same
+# number of tracks (the target layout of reconstruct.create_model)
+def join_momentum_arrays(gpx, gpy, gpz):
+    labels, mask = build_track_labels(gpx, gpy, gpz)
+    if not mask.all():
+        raise Exception("Events have different numbers of tracks; labels need a fixed size.")
+
+    return labels.transpose(0, 2, 1).reshape(len(labels), -1)
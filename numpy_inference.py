@@ -0,0 +1,219 @@
+import argparse
+import json
+import time
+import numpy as np
+from clustering import encode_hits, load_model_encoding, save_model_encoding
+
+# CONSTANTS
+# Keras Dense activations the engine can run
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0, out=x),
+    "sigmoid": lambda x: 1 / (1 + np.exp(-x)),
+    "tanh": np.tanh,
+}
+WEIGHT_DTYPES = ["float32", "float16", "int8"]
+COMPUTE_DTYPES = ["float32", "float16"]
+CALIBRATION_EVENTS = 1024  # events of a ROOT file used for calibration/verification
+CALIBRATION_FRACTION = 0.5  # share of a sample that calibrates int8 activations; the rest verifies
+# calibrated ranges are widened by this factor, since events outside the calibration sample
+# reach past its largest activations and would otherwise be clipped
+CALIBRATION_HEADROOM = 1.25
+# Largest difference from Keras, relative to the output range, that verification accepts for
+# each export. These are empirical: about twice the largest difference measured on
+# runs/trackQA*.root for untrained and trained reconstruct.create_model nets (float16 5e-4,
+# int8 1.1e-2, calibrated int8 1.7e-2 on held-out events), not derived bounds.
+TOLERANCES = {"float32": 1e-4, "float16": 1e-3, "int8": 2.5e-2, "int8-calibrated": 3.5e-2}
+
+# Symmetric per-output-channel int8 quantization of a (inputs, outputs) kernel
+def quantize_int8(kernel):
+    scale = np.abs(kernel).max(axis=0) / 127
+    scale[scale == 0] = 1
+    return np.clip(np.round(kernel / scale), -127, 127).astype(np.int8), scale.astype(np.float32)
+
+# Pure-NumPy forward pass of a Flatten/Dense model exported with export_weights.
+# Weights are stored as float32, float16 or per-channel int8 and are expanded once to the
+# compute dtype when the model is loaded. If the export was calibrated, int8 models also
+# round every layer's input to its calibrated 8-bit grid (weights and activations both 8 bit).
+# dtype=np.float16 also computes in half precision, which halves memory but has no BLAS path
+# in NumPy and is much slower than float32.
+class NumpyModel:
+    def __init__(self, layers, input_shape, dtype=np.float32):
+        self.layers = layers
+        self.input_shape = tuple(input_shape)
+        self.dtype = np.dtype(dtype)
+        self.output_shape = (None, layers[-1]["bias"].shape[0])
+
+    # Load an .npz written by export_weights. weight_dtype re-quantizes the stored weights on
+    # load (e.g. "int8" from a float32 export), so one export can be served at any precision.
+    @classmethod
+    def load(cls, npz_path, dtype=np.float32, weight_dtype=None):
+        with np.load(npz_path) as weights:
+            return cls.from_arrays(json.loads(str(weights["spec"])), dict(weights), dtype, weight_dtype)
+
+    # Build the model from the spec and arrays of an export (see export_weights)
+    @classmethod
+    def from_arrays(cls, spec, arrays, dtype=np.float32, weight_dtype=None):
+        if weight_dtype is not None and weight_dtype not in WEIGHT_DTYPES:
+            raise Exception("weight_dtype must be one of {}.".format(WEIGHT_DTYPES))
+
+        layers = []
+        for i, activation in enumerate(spec["activations"]):
+            kernel = arrays["kernel_{}".format(i)]
+            if kernel.dtype == np.int8:
+                kernel = kernel.astype(np.float32) * arrays["scale_{}".format(i)]
+            if weight_dtype == "int8":
+                kernel, scale = quantize_int8(kernel)
+                kernel = kernel.astype(np.float32) * scale
+            elif weight_dtype is not None:
+                kernel = kernel.astype(weight_dtype)
+
+            layer = {"kernel": kernel.astype(dtype), "bias": arrays["bias_{}".format(i)].astype(dtype), "activation": activation}
+            if "input_scale_{}".format(i) in arrays:
+                layer["input_scale"] = float(arrays["input_scale_{}".format(i)])
+                layer["input_levels"] = tuple(int(level) for level in arrays.get("input_levels_{}".format(i), (-127, 127)))
+            layers.append(layer)
+
+        return cls(layers, spec["input_shape"], dtype)
+
+    # Forward pass over a batch; inputs are flattened like keras.layers.Flatten
+    def predict_on_batch(self, inputs):
+        x = np.asarray(inputs).reshape(len(inputs), -1).astype(self.dtype)
+        for layer in self.layers:
+            if "input_scale" in layer:
+                low, high = layer["input_levels"]
+                x = np.clip(np.round(x / layer["input_scale"]), low, high) * np.asarray(layer["input_scale"], dtype=self.dtype)
+            x = x @ layer["kernel"]
+            x += layer["bias"]
+            x = ACTIVATIONS[layer["activation"]](x)
+
+        return x.astype(np.float32)
+
+    # Forward pass in batches of batch_size inputs
+    def predict(self, inputs, batch_size=4096):
+        if len(inputs) == 0:
+            return np.zeros((0, self.output_shape[-1]), dtype=np.float32)
+        return np.concatenate([self.predict_on_batch(inputs[start:start + batch_size]) for start in range(0, len(inputs), batch_size)])
+
+    # Input of every layer (flattened), for calibration
+    def layer_inputs(self, inputs):
+        x = np.asarray(inputs).reshape(len(inputs), -1).astype(np.float32)
+        inputs_per_layer = []
+        for layer in self.layers:
+            inputs_per_layer.append(x)
+            x = ACTIVATIONS[layer["activation"]](x @ layer["kernel"].astype(np.float32) + layer["bias"].astype(np.float32))
+
+        return inputs_per_layer
+
+# Write the Dense weights of a saved .keras model to a compact .npz the NumPy engine can run.
+# weight_dtype is "float32", "float16" or "int8" (per-channel scales stored next to the kernels).
+# For int8, passing calibration_inputs (a sample of model inputs) also records the range of
+# every layer's input so activations are quantized too: the largest value seen (with
+# CALIBRATION_HEADROOM), on an unsigned 0..255 grid when the input is never negative (hits,
+# ReLU outputs), else -127..127.
+# With verify_inputs the export is checked against Keras first and nothing is written if it
+# differs by more than tolerance (TOLERANCES for the export type by default).
+# Returns that difference, relative to the output range, or None without verify_inputs.
+def export_weights(model_path, npz_path, weight_dtype="float32", calibration_inputs=None, verify_inputs=None, tolerance=None):
+    import tensorflow as tf
+
+    if weight_dtype not in WEIGHT_DTYPES:
+        raise Exception("weight_dtype must be one of {}.".format(WEIGHT_DTYPES))
+
+    model = tf.keras.models.load_model(model_path)
+    kernels, biases, activations = [], [], []
+    for layer in model.layers:
+        if isinstance(layer, (tf.keras.layers.Flatten, tf.keras.layers.InputLayer)):
+            continue
+        if not isinstance(layer, tf.keras.layers.Dense):
+            raise Exception("Layer {} ({}) is not supported by the NumPy engine.".format(layer.name, type(layer).__name__))
+
+        activation = layer.get_config()["activation"]
+        if not isinstance(activation, str) or activation not in ACTIVATIONS:
+            raise Exception("Activation {} of layer {} is not supported by the NumPy engine.".format(activation, layer.name))
+
+        kernel, bias = layer.get_weights() if layer.use_bias else (layer.get_weights()[0], None)
+        kernels.append(kernel)
+        biases.append(bias if bias is not None else np.zeros(kernel.shape[1], dtype=np.float32))
+        activations.append(activation)
+
+    spec = {"input_shape": list(model.input_shape[1:]), "activations": activations, "weight_dtype": weight_dtype}
+    arrays = {}
+    for i, (kernel, bias) in enumerate(zip(kernels, biases)):
+        arrays["bias_{}".format(i)] = bias.astype(np.float32)
+        if weight_dtype == "int8":
+            arrays["kernel_{}".format(i)], arrays["scale_{}".format(i)] = quantize_int8(kernel)
+        else:
+            arrays["kernel_{}".format(i)] = kernel.astype(weight_dtype)
+
+    # calibrate activation ranges on the float model
+    calibrated = weight_dtype == "int8" and calibration_inputs is not None
+    if calibrated:
+        float_layers = [{"kernel": kernel, "bias": bias, "activation": activation} for kernel, bias, activation in zip(kernels, biases, activations)]
+        layer_inputs = NumpyModel(float_layers, spec["input_shape"]).layer_inputs(calibration_inputs)
+        for i, x in enumerate(layer_inputs):
+            unsigned = x.min() >= 0
+            input_range = np.abs(x).max() * CALIBRATION_HEADROOM
+            levels = 255 if unsigned else 127
+            arrays["input_scale_{}".format(i)] = np.float32(input_range / levels if input_range > 0 else 1)
+            arrays["input_levels_{}".format(i)] = np.array([0, 255] if unsigned else [-127, 127], dtype=np.int16)
+
+    # check the engine against Keras before anything is written
+    error = None
+    if verify_inputs is not None:
+        if tolerance is None:
+            tolerance = TOLERANCES["int8-calibrated" if calibrated else weight_dtype]
+        predictions = NumpyModel.from_arrays(spec, arrays).predict(verify_inputs)
+        expected = model.predict(verify_inputs, verbose=0)
+        error = float(np.abs(predictions - expected).max() / max(np.abs(expected).max(), 1e-12))
+        if error > tolerance:
+            raise Exception("NumPy engine differs from Keras by {:.2e} of the output range, more than {}; {} not written.".format(error, tolerance, npz_path))
+
+    np.savez_compressed(npz_path, spec=json.dumps(spec), **arrays)
+    # the export takes its hits encoded like the model it came from
+    save_model_encoding(npz_path, load_model_encoding(model_path)["cluster_hits"])
+    return error
+
+# Hit matrices of the first num_events events of a ROOT file, as calibration/verification inputs
+# (clustered if the model was trained on clusters)
+def hit_matrix_sample(file_path, input_shape, num_events=CALIBRATION_EVENTS, cluster=False):
+    from ingest import ingest_files
+    from hit_encoding import convert_to_hit_matrices
+
+    columns = ingest_files([file_path])[0]
+    max_detector_id, max_element_id = input_shape
+    detector_events, element_events = encode_hits(columns["detectorID"][:num_events], columns["elementID"][:num_events], cluster)
+    return convert_to_hit_matrices(detector_events, element_events, max_detector_id, max_element_id, dtype=np.float32)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a .keras Dense model for the NumPy inference engine")
+    parser.add_argument("model", help=".keras model to export")
+    parser.add_argument("output", help=".npz file to write")
+    parser.add_argument("--weight-dtype", choices=WEIGHT_DTYPES, default="float32", help="storage type of the weights")
+    parser.add_argument("--sample", help="inputs for calibration and verification: a .npy of inputs, or a ROOT file whose hit matrices are used")
+    parser.add_argument("--tolerance", type=float, help="largest allowed difference from Keras, relative to the output range (default depends on the weight dtype)")
+    args = parser.parse_args()
+
+    sample = None
+    if args.sample is not None and args.sample.endswith(".npy"):
+        sample = np.load(args.sample)
+
+    if args.sample is not None and sample is None:
+        import tensorflow as tf
+        sample = hit_matrix_sample(args.sample, tf.keras.models.load_model(args.model).input_shape[1:],
+                                   cluster=load_model_encoding(args.model)["cluster_hits"])
+
+    # int8 activations are calibrated on the first part of the sample and the export is checked
+    # against Keras on the held-out rest, before it's written
+    calibration_sample, verify_sample = None, sample
+    if sample is not None and args.weight_dtype == "int8":
+        split = int(len(sample) * CALIBRATION_FRACTION)
+        if split == 0 or split == len(sample):
+            raise Exception("The sample needs at least two events to calibrate and verify on separate events.")
+        calibration_sample, verify_sample = sample[:split], sample[split:]
+
+    start_time = time.time()
+    error = export_weights(args.model, args.output, args.weight_dtype, calibration_sample, verify_sample, args.tolerance)
+    if error is not None:
+        print("Max difference from Keras: {:.2e} of the output range ({} verification events, {:.3f} s to export and verify)".format(error, len(verify_sample), time.time() - start_time))
+    print("Wrote {}".format(args.output))
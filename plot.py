@@ -1,17 +1,24 @@
-import pandas as pd
+import numpy as np
 import plotly.graph_objects as go
 import plotly.io as pio
 import cv2 
 import os 
-import shutil 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from plotly.subplots import make_subplots
+from heatmap_grid import heatmap_columns, get_heatmap_grid
+from raster import FrameRasterizer
+
+# CONSTANTS
+VIDEO_BATCH_SIZE = 64  # events rasterized per render_batch call by create_video
 
 # Function to create individual heatmaps for each detector
 def create_detector_heatmaps(detector_ids, element_ids, name_to_id_elements, max_element_id, excluded_detector_ids):
-    # Convert data to a DataFrame
-    data = {'Detector': detector_ids, 'Element': element_ids, 'Hit': [1] * len(detector_ids)}
-    df = pd.DataFrame(data)
+    # Fill every detector's column of the display grid in one vectorized step
+    grid = get_heatmap_grid(name_to_id_elements, max_element_id, excluded_detector_ids)
+    event_grid = grid.event_grid(detector_ids, element_ids)
+    grid_columns = {detector_name: col for col, (detector_name, _, _) in enumerate(grid.columns)}
     
     # Create a single row of subplots
     fig = make_subplots(
@@ -31,21 +38,9 @@ def create_detector_heatmaps(detector_ids, element_ids, name_to_id_elements, max
         idx = idx - offset
         current_col = idx + 1  # Column index (1-based)
         
-        detector_data = df[df['Detector'] == detector_id]
-        
-        # Create hit matrix
-        z_matrix = [[0] for _ in range(max_element_id)]
-        block_height = int(max_element_id / num_elements)
-        
-        # Fill hits
-        for _, row in detector_data.iterrows():
-            element_idx = int(row['Element']) - 1 # make 0-indexed
-            if 0 <= element_idx < num_elements:
-                start_idx = element_idx * block_height
-                end_idx = start_idx + block_height
-                for i in range(start_idx, end_idx):
-                    if i < max_element_id:
-                        z_matrix[i] = [1]
+        # Hit matrix of this detector
+        col = grid_columns[detector_name]
+        z_matrix = event_grid[:, col:col + 1].tolist()
         
         fig.add_trace(
             go.Heatmap(
@@ -102,31 +97,190 @@ def create_detector_heatmaps(detector_ids, element_ids, name_to_id_elements, max
 
     return fig
 
-def create_video(detector_ids, element_ids, detector_name_to_id_elements, max_element_id, initial_event_number, excluded_detector_ids, video_name):
-    # create directory for storing images if it doesn't exist already
-    directory = "temp_directory_xyz123"
-    os.makedirs(directory, exist_ok=True)
+# Build the (max_element_id, columns) z grid of one event for the single-trace heatmap.
+# Hit elements are filled with 1 over their block_height rows; hidden detectors are NaN.
+# Which detectors are shown comes from the display flags in name_to_id_elements, or from
+# displayed_detectors (a set of names) if given.
+def create_heatmap_z(detector_ids, element_ids, name_to_id_elements, max_element_id, excluded_detector_ids, displayed_detectors=None):
+    grid = get_heatmap_grid(name_to_id_elements, max_element_id, excluded_detector_ids)
+    z = grid.event_grid(detector_ids, element_ids).astype(float)
+
+    if displayed_detectors is None:
+        hidden = [not name_to_id_elements[detector_name][-1] for detector_name, _, _ in grid.columns]
+    else:
+        hidden = [detector_name not in displayed_detectors for detector_name, _, _ in grid.columns]
+    z[:, hidden] = np.nan
+
+    return z
+
+# Convert a z grid into what goes into the figure JSON (ints, with None for blank cells)
+def heatmap_z_values(z):
+    values = z.astype(object)
+    values[np.isnan(z)] = None
+    values[~np.isnan(z)] = z[~np.isnan(z)].astype(int)
+    return values.tolist()
+
+# Create the single-trace heatmap figure: one go.Heatmap covering every detector column,
+# with axes, tick labels and hover text built once. Event and group changes only need to
+# replace the trace's z (see heatmap_z_values), e.g. with a dash Patch.
+def create_heatmap_figure(z, name_to_id_elements, max_element_id, excluded_detector_ids):
+    columns = heatmap_columns(name_to_id_elements, excluded_detector_ids)
+    column_names = [detector_name for detector_name, _, _ in columns]
+
+    fig = go.Figure(
+        go.Heatmap(
+            z=heatmap_z_values(z),
+            customdata=[column_names] * max_element_id,
+            hovertemplate="Detector: %{customdata}<br>" +
+                          "Element ID: %{y}<br>" +
+                          "Status: %{z:d}<extra></extra>",
+            colorscale=[[0, 'blue'], [1, 'orange']],
+            showscale=False,
+            xgap=0,
+            ygap=0,
+            hoverongaps=False,
+            zmin=0,
+            zmax=1
+        )
+    )
+
+    # Add vertical detector names
+    fig.update_xaxes(
+        title='',
+        showgrid=False,
+        zeroline=False,
+        showline=False,
+        showticklabels=True,
+        tickmode='array',
+        tickvals=list(range(len(columns))),
+        ticktext=[f"{detector_name} ({num_elements})" for detector_name, _, num_elements in columns],
+        tickangle=270
+    )
+
+    fig.update_yaxes(
+        title_text="Element ID",
+        range=[0, max_element_id],
+        showticklabels=True,
+        gridcolor="lightgray",
+        dtick=20
+    )
+
+    fig.update_layout(
+        height=800,
+        margin=dict(t=0, b=0, l=0, r=0),  # Remove margins
+        plot_bgcolor="rgba(0,0,0,0)",  # Transparent background for the plot
+        paper_bgcolor="rgba(0,0,0,0)",  # Transparent background for the paper
+        showlegend=False,
+        uirevision="heatmap"  # keep zoom/pan when z is patched
+    )
+
+    return fig
+
+# Hits per displayed detector column from per-detector-id counts (e.g. RollingDetectorCounts.total)
+def detector_hit_counts(counts, name_to_id_elements, excluded_detector_ids):
+    columns = heatmap_columns(name_to_id_elements, excluded_detector_ids)
+    return [int(counts[detector_id]) if detector_id < len(counts) else 0 for _, detector_id, _ in columns]
+
+# Create the rolling hit histogram for live mode: one bar per detector column of the heatmap.
+# Updates only need to replace the bar heights (see detector_hit_counts).
+def create_hit_histogram(counts, name_to_id_elements, excluded_detector_ids, num_events):
+    columns = heatmap_columns(name_to_id_elements, excluded_detector_ids)
+
+    fig = go.Figure(
+        go.Bar(
+            x=[f"{detector_name} ({num_elements})" for detector_name, _, num_elements in columns],
+            y=detector_hit_counts(counts, name_to_id_elements, excluded_detector_ids),
+            marker_color='orange',
+            hovertemplate="Detector: %{x}<br>Hits: %{y}<extra></extra>"
+        )
+    )
+
+    fig.update_xaxes(tickangle=270)
+    fig.update_yaxes(title_text="Hits", gridcolor="lightgray")
+    fig.update_layout(
+        title=f"Hits per detector, last {num_events} events",
+        height=400,
+        margin=dict(t=40, b=0, l=0, r=0),
+        plot_bgcolor="rgba(0,0,0,0)",
+        paper_bgcolor="rgba(0,0,0,0)",
+        showlegend=False,
+        uirevision="histogram"
+    )
+
+    return fig
+
+# Settings each frame-rendering worker process needs, set once by _init_frame_worker
+frame_worker_settings = dict()
+
+def _init_frame_worker(detector_name_to_id_elements, max_element_id, excluded_detector_ids):
+    frame_worker_settings["name_to_id_elements"] = detector_name_to_id_elements
+    frame_worker_settings["max_element_id"] = max_element_id
+    frame_worker_settings["excluded_detector_ids"] = excluded_detector_ids
+
+# Render one event to a raw BGR frame in a worker process. kaleido only produces encoded
+# images, so the PNG is decoded in memory right away and never touches the disk.
+def _render_frame(detector_ids, element_ids):
+    fig = create_detector_heatmaps(
+        detector_ids,
+        element_ids,
+        frame_worker_settings["name_to_id_elements"],
+        frame_worker_settings["max_element_id"],
+        frame_worker_settings["excluded_detector_ids"]
+    )
+    png = pio.to_image(fig, format="png")
+    return cv2.imdecode(np.frombuffer(png, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+# Render events initial_event_number.. into a video.
+# renderer="raster" draws frames directly with raster.FrameRasterizer (thousands of frames/s).
+# renderer="plotly" renders the plotly figures through kaleido in a process pool; frames come
+# back through a bounded queue of futures kept in event order, so they go straight to the
+# encoder in the right order with at most max_pending frames in memory and no temp files.
+def create_video(detector_ids, element_ids, detector_name_to_id_elements, max_element_id, initial_event_number, excluded_detector_ids, video_name, max_workers=None, fps=1, renderer="raster"):
+    if renderer == "raster":
+        rasterizer = FrameRasterizer(detector_name_to_id_elements, max_element_id, excluded_detector_ids)
+        video = cv2.VideoWriter(video_name, 0, fps, (rasterizer.width, rasterizer.height))
+
+        # rasterize a batch of events at a time into one reused frame buffer
+        frames = rasterizer.new_frames(VIDEO_BATCH_SIZE)
+        print("Generating video frames...")
+        with tqdm(total=max(len(detector_ids) - initial_event_number, 0)) as progress:
+            for start in range(initial_event_number, len(detector_ids), VIDEO_BATCH_SIZE):
+                stop = min(start + VIDEO_BATCH_SIZE, len(detector_ids))
+                for frame in rasterizer.render_batch(detector_ids[start:stop], element_ids[start:stop], out=frames):
+                    video.write(frame)
+                progress.update(stop - start)
+
+        video.release()
+        return
+
+    max_workers = max_workers or os.cpu_count()
+    max_pending = 2 * max_workers
+    event_numbers = iter(range(initial_event_number, len(detector_ids)))
+    num_frames = len(detector_ids) - initial_event_number
 
-    # populate directory with heatmap frames 
-    print("Generating frames...")
-    for event_number in tqdm(range(initial_event_number, len(detector_ids))):
-        fig = create_detector_heatmaps(detector_ids[event_number], element_ids[event_number], detector_name_to_id_elements, max_element_id, excluded_detector_ids)
-        pio.write_image(fig, os.path.join(directory, "frame{}.png".format(event_number - initial_event_number + 1)))
+    video = None
+    pending = deque()
 
-    # convert directory of frames into video
-    images = os.listdir(directory)
-    frame = cv2.imread(os.path.join(directory, images[0]))
-    height, width, layers = frame.shape
+    print("Generating video frames...")
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_frame_worker,
+                             initargs=(detector_name_to_id_elements, max_element_id, excluded_detector_ids)) as executor:
+        def submit_next():
+            event_number = next(event_numbers, None)
+            if event_number is not None:
+                pending.append(executor.submit(_render_frame, np.asarray(detector_ids[event_number]), np.asarray(element_ids[event_number])))
 
-    video = cv2.VideoWriter(video_name, 0, 1, (width,height))
+        for _ in range(max_pending):
+            submit_next()
 
-    print("Converting frames to video...")
-    for image in tqdm(images):
-        video.write(cv2.imread(os.path.join(directory, image)))
+        for _ in tqdm(range(num_frames)):
+            frame = pending.popleft().result()
+            submit_next()
 
-    cv2.destroyAllWindows()
-    video.release()
+            # open the encoder once the frame size is known
+            if video is None:
+                height, width, layers = frame.shape
+                video = cv2.VideoWriter(video_name, 0, fps, (width, height))
+            video.write(frame)
 
-    # remove temp directory of heatmap frames 
-    print("Cleaning up files...")
-    shutil.rmtree(directory)
+    if video is not None:
+        video.release()
@@ -0,0 +1,125 @@
+import numpy as np
+
+# CONSTANTS
+# value the DAQ writes into unused slots of the fixed-width detectorID/elementID branches
+HIT_PADDING = 32767
+
+# Variable-length per-event data stored CSR-style: event i owns values[offsets[i]:offsets[i + 1]].
+# Indexing an event returns a view into values, and slicing a range of events returns another
+# RaggedArray that shares the same values buffer, so memory-mapped arrays are never copied.
+class RaggedArray:
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise Exception("RaggedArray only supports contiguous slices.")
+            stop = max(start, stop)
+            return RaggedArray(self.offsets[start:stop + 1], self.values)
+
+        if index < 0:
+            index += len(self)
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    # number of values in each event
+    def counts(self):
+        return np.diff(self.offsets)
+
+    # all values of the events in this array as one flat array
+    def flat(self):
+        return self.values[self.offsets[0]:self.offsets[-1]]
+
+    # index of the event each value in flat() belongs to
+    def event_index(self):
+        return np.repeat(np.arange(len(self)), self.counts())
+
+    # convert back to the object array of per-event arrays that uproot returns
+    def to_object_array(self):
+        events = np.empty(len(self), dtype=object)
+        for index in range(len(self)):
+            events[index] = self[index]
+        return events
+
+# Convert an awkward array (what uproot returns with library="ak") to NumPy without a loop
+# over events: jagged branches become a RaggedArray over the list offsets and values of the
+# layout, fixed-width and scalar branches a regular NumPy array.
+def from_awkward(events):
+    import awkward as ak
+
+    layout = ak.to_layout(events)
+    if isinstance(layout, ak.contents.ListOffsetArray) and isinstance(layout.content, ak.contents.NumpyArray):
+        return RaggedArray(np.asarray(layout.offsets.data, dtype=np.int64), layout.content.data)
+    if layout.purelist_isregular:
+        return ak.to_numpy(events)
+    return RaggedArray(counts_to_offsets(ak.to_numpy(ak.num(events))), ak.to_numpy(ak.flatten(events)))
+
+# Flatten events into (counts, flat values). Accepts a RaggedArray, an awkward array, a
+# regular 2D array (fixed-width branches), or an object array or list of per-event arrays.
+# Only the last form needs a loop over events; jagged branches read with library="ak" (as
+# file_read does) go through their offsets instead.
+def flatten_events(events):
+    if type(events).__module__.startswith("awkward"):
+        events = from_awkward(events)
+    if isinstance(events, RaggedArray):
+        return events.counts(), events.flat()
+
+    if not isinstance(events, (list, tuple)):
+        events = np.asarray(events)
+    if isinstance(events, np.ndarray) and events.dtype != object:
+        if events.ndim == 1:
+            return np.ones(len(events), dtype=np.int64), events
+        return np.full(len(events), events.shape[1], dtype=np.int64), events.reshape(-1)
+
+    counts = np.fromiter((len(event) for event in events), dtype=np.int64, count=len(events))
+    if counts.sum() == 0:
+        return counts, np.zeros(0, dtype=np.float32)
+    return counts, np.concatenate([event for event in events if len(event) > 0])
+
+# Build offsets (length N + 1) from per-event counts
+def counts_to_offsets(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+# Convert events in any layout accepted by flatten_events into a RaggedArray
+def as_ragged(events):
+    if isinstance(events, RaggedArray):
+        return events
+
+    counts, values = flatten_events(events)
+    return RaggedArray(counts_to_offsets(counts), values)
+
+# Convert detector/element id events into two RaggedArrays that share offsets, dropping
+# the HIT_PADDING slots of fixed-width branches so each event only holds its real hits
+def ragged_hits(detector_events, element_events, padding=HIT_PADDING):
+    counts, detector_values = flatten_events(detector_events)
+    element_counts, element_values = flatten_events(element_events)
+    if not np.array_equal(counts, element_counts):
+        raise Exception("detectorID and elementID have different numbers of hits.")
+
+    keep = (detector_values != padding) & (element_values != padding)
+    if not keep.all():
+        event_index = np.repeat(np.arange(len(counts)), counts)
+        counts = np.bincount(event_index[keep], minlength=len(counts))
+        detector_values = detector_values[keep]
+        element_values = element_values[keep]
+
+    offsets = counts_to_offsets(counts)
+    return RaggedArray(offsets, detector_values), RaggedArray(offsets, element_values)
+
+# Join several RaggedArrays (e.g. one per file) into one
+def concatenate_ragged(arrays):
+    arrays = [as_ragged(array) for array in arrays]
+    counts = np.concatenate([array.counts() for array in arrays])
+    values = np.concatenate([array.flat() for array in arrays])
+    return RaggedArray(counts_to_offsets(counts), values)
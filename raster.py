@@ -0,0 +1,116 @@
+import numpy as np
+import cv2
+from heatmap_grid import get_heatmap_grid
+
+# CONSTANTS
+FRAME_WIDTH = 1280
+FRAME_HEIGHT = 800
+LEFT_MARGIN = 60  # room for the element id axis
+BOTTOM_MARGIN = 110  # room for the vertical detector labels
+TOP_MARGIN = 10
+RIGHT_MARGIN = 10
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+# BGR colors of the detector display
+NO_HIT_COLOR = (255, 0, 0)  # blue
+HIT_COLOR = (0, 165, 255)  # orange
+BACKGROUND_COLOR = (255, 255, 255)
+TEXT_COLOR = (0, 0, 0)
+
+# Draws the detector display of create_detector_heatmaps (one column per displayed detector,
+# element blocks of max_element_id / num_elements rows, hit/no-hit colors, detector labels)
+# straight into uint8 BGR frames without plotly. The background, axis and labels are drawn
+# once; every frame is then the event's display grid colored and scaled into the plot area
+# with a nearest-neighbour cv2.resize written in place.
+class FrameRasterizer:
+    def __init__(self, name_to_id_elements, max_element_id, excluded_detector_ids, width=FRAME_WIDTH, height=FRAME_HEIGHT):
+        self.grid = get_heatmap_grid(name_to_id_elements, max_element_id, excluded_detector_ids)
+        self.max_element_id = max_element_id
+        self.width = width
+        self.height = height
+        self.plot_x0, self.plot_x1 = LEFT_MARGIN, width - RIGHT_MARGIN
+        self.plot_y0, self.plot_y1 = TOP_MARGIN, height - BOTTOM_MARGIN
+
+        # grid columns of the detectors that are displayed, left to right
+        self.displayed_columns = [
+            col for col, (detector_name, _, _) in enumerate(self.grid.columns) if name_to_id_elements[detector_name][-1]
+        ]
+        self.colors = np.array([NO_HIT_COLOR, HIT_COLOR], dtype=np.uint8)
+
+        self.background = self._draw_background(name_to_id_elements)
+
+    # Static part of every frame: background, element id axis and detector labels
+    def _draw_background(self, name_to_id_elements):
+        frame = np.full((self.height, self.width, 3), BACKGROUND_COLOR, dtype=np.uint8)
+        plot_height = self.plot_y1 - self.plot_y0
+        plot_width = self.plot_x1 - self.plot_x0
+
+        # element id ticks every 20
+        for tick in range(0, self.max_element_id + 1, 20):
+            y = self.plot_y1 - int(round(tick * plot_height / self.max_element_id))
+            text = str(tick)
+            (text_width, text_height), _ = cv2.getTextSize(text, FONT, 0.4, 1)
+            cv2.putText(frame, text, (self.plot_x0 - text_width - 4, y + text_height // 2), FONT, 0.4, TEXT_COLOR, 1, cv2.LINE_AA)
+        self._paste_vertical_text(frame, "Element ID", 4, self.plot_y0 + plot_height // 2, 0.5, center=True)
+
+        # vertical detector labels under their columns
+        num_columns = len(self.displayed_columns)
+        for i, col in enumerate(self.displayed_columns):
+            detector_name, _, num_elements = self.grid.columns[col]
+            x = self.plot_x0 + int((i + 0.5) * plot_width / num_columns)
+            self._paste_vertical_text(frame, f"{detector_name} ({num_elements})", x, self.plot_y1 + 4, 0.35)
+
+        return frame
+
+    # Draw text rotated to read bottom-to-top, hanging down from y and centered on x
+    # (or, with center=True, centered on y with its left edge at x)
+    def _paste_vertical_text(self, frame, text, x, y, scale, center=False):
+        (text_width, text_height), baseline = cv2.getTextSize(text, FONT, scale, 1)
+        label = np.full((text_height + baseline + 2, text_width + 2, 3), BACKGROUND_COLOR, dtype=np.uint8)
+        cv2.putText(label, text, (1, text_height + 1), FONT, scale, TEXT_COLOR, 1, cv2.LINE_AA)
+        label = cv2.rotate(label, cv2.ROTATE_90_COUNTERCLOCKWISE)
+
+        label_height, label_width = label.shape[:2]
+        top = y - label_height // 2 if center else y
+        left = x if center else x - label_width // 2
+        top, left = max(top, 0), max(left, 0)
+        bottom, right = min(top + label_height, self.height), min(left + label_width, self.width)
+        frame[top:bottom, left:right] = label[:bottom - top, :right - left]
+
+    # Frames holding only the static background, to be filled by render_batch
+    def new_frames(self, num_frames):
+        return np.broadcast_to(self.background, (num_frames,) + self.background.shape).copy()
+
+    # Draw display grids into the plot areas of frames. The grids are colored (element id 1
+    # at the bottom) and scaled up with nearest-neighbour interpolation straight into each
+    # frame, so nothing outside the plot area is touched.
+    def _draw_grids(self, grids, frames):
+        if len(self.displayed_columns) == 0:
+            return
+        colored = self.colors[grids[:, ::-1][:, :, self.displayed_columns]]
+        plot_size = (self.plot_x1 - self.plot_x0, self.plot_y1 - self.plot_y0)
+        for grid, frame in zip(colored, frames):
+            cv2.resize(grid, plot_size, dst=frame[self.plot_y0:self.plot_y1, self.plot_x0:self.plot_x1], interpolation=cv2.INTER_NEAREST)
+
+    # Frame of an event's (max_element_id, columns) display grid
+    def render_grid(self, grid):
+        frames = self.new_frames(1)
+        self._draw_grids(grid[np.newaxis], frames)
+        return frames[0]
+
+    # Frame of one event
+    def render(self, detector_ids, element_ids):
+        return self.render_grid(self.grid.event_grid(detector_ids, element_ids))
+
+    # Frames of many events as one (num_events, height, width, 3) array, using one batched grid
+    # computation. out can be the frames of an earlier call (or new_frames) to reuse them: the
+    # background never changes, so only the plot areas are redrawn.
+    def render_batch(self, detector_events, element_events, out=None):
+        grids = self.grid.event_grids(detector_events, element_events)
+        if out is None:
+            out = self.new_frames(len(grids))
+        elif len(out) < len(grids):
+            raise Exception("Frame buffer holds {} frames, {} are needed.".format(len(out), len(grids)))
+        frames = out[:len(grids)]
+        self._draw_grids(grids, frames)
+
+        return frames
@@ -1,13 +1,30 @@
 import uproot
 import tensorflow as tf 
-import numpy as np 
-from file_read import get_detector_info, read_events, choose_root, find_tree
+from file_read import get_detector_info, find_tree
+from event_cache import open_cache, CACHE_DIR
+from input_pipeline import build_dataset
+# hit encoders and the label builder, importable from here as before
+from hit_encoding import convert_to_hit_matrices, convert_to_sparse_hit_matrices
+from labels import join_momentum_arrays
+from clustering import save_model_encoding
 
 # CONSTANTS
 SPECTROMETER_INFO_PATH = "spectrometer.csv"
+INGEST_WORKERS = None  # number of processes used to decode ROOT files (None = all cores)
+BATCH_SIZE = 32  # events densified per training/inference batch
+# "dense": create_model on full hit matrices
+# "sparse": create_sparse_model on the hit channel ids of each event
+MODEL_TYPE = "dense"
+CLUSTER_HITS = False  # merge hits on adjacent wires (clustering.cluster_hits) before encoding
+
+# read momentum values from root file (from the event cache if cache_dir is given)
+def read_momentum(file_path, cache_dir=None):
+    if cache_dir is not None:
+        columns = open_cache(file_path, cache_dir)
+        if "gpx" not in columns or "gpy" not in columns or "gpz" not in columns:
+            raise Exception("Momentum values missing from ROOT file.")
+        return columns["gpx"], columns["gpy"], columns["gpz"]
 
-# read momentum values from root file
-def read_momentum(file_path):
     with uproot.open(file_path) as file:
         # get tree 
         tree = find_tree(file)
@@ -21,19 +38,6 @@ def read_momentum(file_path):
     
     return momentum_arrays["gpx"], momentum_arrays["gpy"], momentum_arrays["gpz"]
     
-# convert detector and element id matrices into hit matrices
-def convert_to_hit_matrices(detector_events, element_events, max_detector_id, max_element_id):
-    num_events = detector_events.shape[0]
-    print(num_events)
-    hit_matrices = np.zeros((num_events, max_detector_id, max_element_id), dtype=int)
-
-    for event_idx in range(num_events):
-        detectors = detector_events[event_idx] - 1  # convert to 0-indexed
-        elements = element_events[event_idx] - 1 
-        hit_matrices[event_idx, detectors, elements] = 1
-
-    return hit_matrices
-
 # create tensorflow model for training on hit data
 def create_model():
     model = tf.keras.models.Sequential([
@@ -45,12 +49,48 @@ def create_model():
 
     return model
 
-def join_momentum_arrays(gpx, gpy, gpz):
-    joined_events = []
-    for px, py, pz in zip(gpx, gpy, gpz):
-        joined_event = np.concatenate((px, py, pz))
-        joined_events.append(joined_event)
-    return np.array(joined_events)
+# First layer of create_sparse_model: the Dense layer of create_model applied to a 0/1 hit
+# matrix, computed as the sum of the kernel rows of the hit channels. Takes (batch, hits) int
+# channel ids padded with -1, so its cost scales with the number of hits instead of channels.
+@tf.keras.utils.register_keras_serializable(package="reconstruct")
+class EmbeddingBag(tf.keras.layers.Layer):
+    def __init__(self, num_channels, units, activation=None, **kwargs):
+        super().__init__(**kwargs)
+        self.num_channels = num_channels
+        self.units = units
+        self.activation = tf.keras.activations.get(activation)
+
+    def build(self, input_shape):
+        self.embeddings = self.add_weight(name="embeddings", shape=(self.num_channels, self.units), initializer="glorot_uniform")
+        self.bias = self.add_weight(name="bias", shape=(self.units,), initializer="zeros")
+
+    def call(self, channels):
+        channels = tf.cast(channels, tf.int32)
+        hit = channels >= 0
+        rows = tf.gather(self.embeddings, tf.where(hit, channels, 0))
+        summed = tf.reduce_sum(rows * tf.cast(hit, rows.dtype)[..., tf.newaxis], axis=1)
+        return self.activation(summed + self.bias)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "num_channels": self.num_channels,
+            "units": self.units,
+            "activation": tf.keras.activations.serialize(self.activation),
+        })
+        return config
+
+# create the sparse-input variant of create_model, taking each event's hit channel ids
+# ((detector - 1) * max_element_id + element - 1, padded with -1) instead of the hit matrix
+def create_sparse_model(max_detector_id, max_element_id, units=512):
+    model = tf.keras.models.Sequential([
+        tf.keras.Input(shape=(None,), dtype="int32"),
+        EmbeddingBag(max_detector_id * max_element_id, units, activation='relu'),
+        tf.keras.layers.Dense(256, activation='relu'),
+        tf.keras.layers.Dense(6)
+    ])
+
+    return model
 
 if __name__ == "__main__":
     # List of all .root files to process
@@ -66,66 +106,33 @@ if __name__ == "__main__":
         "runs/trackQA9.root"
     ]
 
-    all_detector_ids = []
-    all_element_ids = []
-    all_gpx = []
-    all_gpy = []
-    all_gpz = []
-
-    # Loop through each file and aggregate data
-    for root_file in root_files:
-        print(f"Processing file: {root_file}")
-        
-        # Read detector and element IDs from the file
-        detector_ids, element_ids = read_events(root_file)
-        all_detector_ids.append(detector_ids)
-        all_element_ids.append(element_ids)
-        
-        # Read momentum values from the file
-        gpx, gpy, gpz = read_momentum(root_file)
-        all_gpx.append(gpx)
-        all_gpy.append(gpy)
-        all_gpz.append(gpz)
-
-    # Concatenate all the data
-    print("Concatenating data...")
-    all_detector_ids = np.concatenate(all_detector_ids)
-    all_element_ids = np.concatenate(all_element_ids)
-    all_gpx = np.concatenate(all_gpx)
-    all_gpy = np.concatenate(all_gpy)
-    all_gpz = np.concatenate(all_gpz)
-
     # process spectrometer file and get max detector/element id
     print("Processing spectrometer file...")
     detector_name_to_id_elements = get_detector_info(SPECTROMETER_INFO_PATH)
     max_detector_id = max([detector_name_to_id_elements[name][0] for name in detector_name_to_id_elements])
     max_element_id = max([detector_name_to_id_elements[name][1] for name in detector_name_to_id_elements])
 
-    # filter out data beyond max detector id and max element id
-    print("Filtering data...")
-    all_detector_ids = np.where(all_detector_ids <= max_detector_id, all_detector_ids, 0)
-    all_element_ids = np.where(all_element_ids <= max_element_id, all_element_ids, 0)
-
-    # process root data into hit matrices\
-    print("Converting to hit matrices...")
-    hit_matrices = convert_to_hit_matrices(all_detector_ids, all_element_ids, max_detector_id, max_element_id)
-
-    # process momentum lists into one big array (labels)
-    print("Joining momentum arrays...")
-    labels = join_momentum_arrays(all_gpx, all_gpy, all_gpz)
+    # stream the files (converted to the event cache in parallel first) into shuffled,
+    # prefetched batches of hit matrices and labels
+    # (hits beyond max detector id and max element id are dropped)
+    print("Building input pipeline...")
+    dataset = build_dataset(root_files, max_detector_id, max_element_id, batch_size=BATCH_SIZE, cache_dir=CACHE_DIR,
+                            max_workers=INGEST_WORKERS, sparse_inputs=MODEL_TYPE == "sparse", cluster=CLUSTER_HITS)
 
     # create and compile the TensorFlow model
     print("Creating model...")
-    model = create_model()
+    model = create_sparse_model(max_detector_id, max_element_id) if MODEL_TYPE == "sparse" else create_model()
     model_loss = tf.keras.losses.MeanSquaredError()
     model.compile(optimizer='adam', loss=model_loss, metrics=["mean_squared_error"])
 
     # train the model
     print("Training model...")
-    model.fit(hit_matrices, labels, epochs=5)
+    model.fit(dataset, epochs=5)
 
     print("Training complete!")
 
     model_save_path = "models/hit_to_momentum_model.keras"
     model.save(model_save_path)
+    # evaluation and serving read this back to encode hits the way the model was trained
+    save_model_encoding(model_save_path, CLUSTER_HITS)
     print(f"Model saved at {model_save_path}")
\ No newline at end of file
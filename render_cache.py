@@ -0,0 +1,73 @@
+import threading
+from collections import OrderedDict
+
+# Thread-safe least-recently-used cache bounded by the total (approximate) size of its values
+# in bytes rather than by entry count
+class LRUCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, num_bytes):
+        with self._lock:
+            if key in self._entries:
+                self.num_bytes -= self._entries.pop(key)[1]
+            if num_bytes > self.max_bytes:
+                return
+
+            self._entries[key] = (value, num_bytes)
+            self.num_bytes += num_bytes
+
+            # evict the least recently used entries until we fit again
+            while self.num_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.num_bytes -= evicted_bytes
+
+# Background thread that renders upcoming requests ahead of time. Each call to schedule
+# replaces the jobs that haven't started yet, so a user skipping around never leaves a
+# backlog of stale work behind; at most one job runs at a time.
+class Prefetcher:
+    def __init__(self, render):
+        self.render = render
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    # jobs is a list of argument tuples for render, in the order they should run
+    def schedule(self, jobs):
+        with self._lock:
+            self._jobs = list(jobs)
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                if len(self._jobs) == 0:
+                    self._wakeup.clear()
+                    continue
+                args = self._jobs.pop(0)
+
+            try:
+                self.render(*args)
+            except Exception as error:
+                print("Prefetch of {} failed: {}".format(args, error))
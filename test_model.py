@@ -1,7 +1,10 @@
 import tensorflow as tf
 import numpy as np
-from file_read import read_events, get_detector_info
-from reconstruct import read_momentum, convert_to_hit_matrices, join_momentum_arrays
+from file_read import get_detector_info
+from event_cache import CACHE_DIR
+from input_pipeline import build_dataset
+from reconstruct import BATCH_SIZE, EmbeddingBag
+from clustering import load_model_encoding
 import matplotlib.pyplot as plt
 
 # CONSTANTS
@@ -18,50 +21,34 @@ test_root_files = [
     "runs/trackQA10.root"
 ]
 
-# Process test files 
-all_test_detector_ids = []
-all_test_element_ids = []
-all_test_gpx = []
-all_test_gpy = []
-all_test_gpz = []
-
-for test_file in test_root_files:
-    detector_ids, element_ids = read_events(test_file)
-    all_test_detector_ids.append(detector_ids)
-    all_test_element_ids.append(element_ids)
-
-    gpx, gpy, gpz = read_momentum(test_file)
-    all_test_gpx.append(gpx)
-    all_test_gpy.append(gpy)
-    all_test_gpz.append(gpz)
-
-# Concatenate test data
-all_test_detector_ids = np.concatenate(all_test_detector_ids)
-all_test_element_ids = np.concatenate(all_test_element_ids)
-all_test_gpx = np.concatenate(all_test_gpx)
-all_test_gpy = np.concatenate(all_test_gpy)
-all_test_gpz = np.concatenate(all_test_gpz)
-
 # Get max IDs from spectrometer file
 detector_name_to_id_elements = get_detector_info(SPECTROMETER_INFO_PATH)
 max_detector_id = max([detector_name_to_id_elements[name][0] for name in detector_name_to_id_elements])
 max_element_id = max([detector_name_to_id_elements[name][1] for name in detector_name_to_id_elements])
 
-# Filter and process test data
-all_test_detector_ids = np.where(all_test_detector_ids <= max_detector_id, all_test_detector_ids, 0)
-all_test_element_ids = np.where(all_test_element_ids <= max_element_id, all_test_element_ids, 0)
-
-test_hit_matrices = convert_to_hit_matrices(all_test_detector_ids, all_test_element_ids, max_detector_id, max_element_id)
-test_labels = join_momentum_arrays(all_test_gpx, all_test_gpy, all_test_gpz)
+# Stream test data through the same input pipeline used for training, in file order
+# (hits beyond max detector id and max element id are dropped; sparse models get channel ids,
+# and hits are clustered if the model was trained on clusters)
+sparse_inputs = any(isinstance(layer, EmbeddingBag) for layer in model.layers)
+cluster = load_model_encoding(MODEL_PATH)["cluster_hits"]
+test_dataset = build_dataset(test_root_files, max_detector_id, max_element_id, batch_size=BATCH_SIZE, shuffle=False, cache_dir=CACHE_DIR,
+                             sparse_inputs=sparse_inputs, cluster=cluster)
 
-# Evaluate the model
+# Predict and collect the labels in one pass over the test files, then score from those
+# (the model is trained on mean squared error, so its loss is the MSE as well)
 print("Evaluating model...")
-loss, mse = model.evaluate(test_hit_matrices, test_labels)
-print(f"Test Loss: {loss}")
+predictions = []
+test_labels = []
+for test_hit_matrices, labels in test_dataset:
+    predictions.append(model.predict_on_batch(test_hit_matrices))
+    test_labels.append(labels.numpy())
+predictions = np.concatenate(predictions)
+test_labels = np.concatenate(test_labels)
+mse = float(np.mean(np.square(test_labels - predictions)))
+print(f"Test Loss: {mse}")
 print(f"Mean Squared Error: {mse}")
 
 # Predictions
-predictions = model.predict(test_hit_matrices)
 print(f"Predictions: {predictions[:5]}")
 print(f"Actual: {test_labels[:5]}")
 
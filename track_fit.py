@@ -0,0 +1,118 @@
+import numpy as np
+from geometry import load_geometry
+from ragged import as_ragged
+
+# CONSTANTS
+# drift chamber stations and the plane name prefixes that belong to them
+STATIONS = {
+    "D0": ["D0"],
+    "D1": ["D1"],
+    "D2": ["D2"],
+    "D3p": ["D3p"],
+    "D3m": ["D3m"],
+}
+# tracks bend in KMag between D1 and D2, so by default lines are fitted downstream of it
+DEFAULT_FIT_STATIONS = ["D2", "D3p", "D3m"]
+NUM_PARAMETERS = 4  # x0, tx, y0, ty
+MAX_CONDITION = 1e12  # normal matrices worse conditioned than this are left unfitted
+
+# Plane indices (of geometry.plane_ids) belonging to some stations. Station prefixes are
+# matched longest first, so D3p/D3m planes never count as another station.
+def station_planes(geometry, stations=DEFAULT_FIT_STATIONS):
+    planes = []
+    for plane, plane_name in enumerate(geometry.plane_names):
+        for station in sorted(STATIONS, key=len, reverse=True):
+            if any(plane_name.startswith(prefix) for prefix in STATIONS[station]):
+                if station in stations:
+                    planes.append(plane)
+                break
+
+    return np.array(planes, dtype=np.int64)
+
+# Weighted least-squares fit of one straight line x = x0 + tx * z, y = y0 + ty * z per group
+# of hits, for any number of groups at once. Hit i measures u_i = x * cos_i + y * sin_i at z_i
+# with weight w_i (1 / sigma^2), so each group is a 4 parameter linear problem: the 4 x 4
+# normal equations of every group are summed with np.bincount and solved in one stacked
+# np.linalg.solve. group holds the group index of each hit (-1 for hits that aren't used).
+# Returns a dict of per-group arrays (x0, tx, y0, ty at z = 0, chi2, ndf, num_hits, valid)
+# plus the per-hit residuals (NaN for unused hits or unfitted groups).
+def fit_lines(position, z, cos, sin, weight, group, num_groups):
+    position, z, cos, sin, weight = [np.asarray(array, dtype=np.float64) for array in (position, z, cos, sin, weight)]
+    group = np.asarray(group, dtype=np.int64)
+
+    used = group >= 0
+    g = group[used]
+    u, zz, w = position[used], z[used], weight[used]
+
+    # fit in z relative to the mean z of the hits to keep the normal matrices well conditioned
+    z_ref = zz.mean() if len(zz) > 0 else 0.0
+    dz = zz - z_ref
+    design = np.stack([cos[used], cos[used] * dz, sin[used], sin[used] * dz], axis=1)
+
+    normal = np.zeros((num_groups, NUM_PARAMETERS, NUM_PARAMETERS))
+    for i in range(NUM_PARAMETERS):
+        for j in range(i, NUM_PARAMETERS):
+            normal[:, i, j] = normal[:, j, i] = np.bincount(g, weights=w * design[:, i] * design[:, j], minlength=num_groups)
+    rhs = np.stack([np.bincount(g, weights=w * design[:, i] * u, minlength=num_groups) for i in range(NUM_PARAMETERS)], axis=1)
+    num_hits = np.bincount(g, minlength=num_groups)
+
+    # groups with too few hits or views to constrain the line are left unfitted
+    valid = num_hits >= NUM_PARAMETERS
+    if valid.any():
+        valid[valid] = np.linalg.cond(normal[valid]) < MAX_CONDITION
+
+    parameters = np.full((num_groups, NUM_PARAMETERS), np.nan)
+    if valid.any():
+        parameters[valid] = np.linalg.solve(normal[valid], rhs[valid][..., np.newaxis])[..., 0]
+
+    # residuals and chi2
+    predicted = (design * parameters[g]).sum(axis=1)
+    residuals = np.full(len(position), np.nan)
+    residuals[used] = u - predicted
+    chi2 = np.bincount(g, weights=np.nan_to_num(w * (u - predicted) ** 2), minlength=num_groups).astype(np.float64)
+    chi2[~valid] = np.nan
+
+    x_ref, tx, y_ref, ty = parameters.T
+    return {
+        "x0": x_ref - tx * z_ref,
+        "tx": tx,
+        "y0": y_ref - ty * z_ref,
+        "ty": ty,
+        "chi2": chi2,
+        "ndf": num_hits - NUM_PARAMETERS,
+        "num_hits": num_hits,
+        "valid": valid,
+        "residuals": residuals,
+    }
+
+# Fit straight lines to the hits of many events. Hits on the planes of the chosen stations are
+# turned into wire coordinates through the geometry lookup table and fitted with fit_lines
+# (weight 12 / cell_spacing^2, i.e. no drift distance). By default every event is one group;
+# pass track_labels (one int per hit, -1 to drop the hit, e.g. from a track finder) to fit
+# each (event, label) pair as its own track. Returns the fit_lines dict plus, per group, the
+# event it came from and its label.
+def fit_events(detector_events, element_events, track_labels=None, geometry=None, stations=DEFAULT_FIT_STATIONS):
+    geometry = geometry if geometry is not None else load_geometry()
+    detector_events = as_ragged(detector_events)
+    element_events = as_ragged(element_events)
+
+    hits = geometry.hit_geometry(detector_events.flat(), element_events.flat(), ("position", "z", "cos", "sin", "spacing", "plane"))
+    event_index = detector_events.event_index()
+    labels = np.zeros(len(event_index), dtype=np.int64) if track_labels is None else np.asarray(as_ragged(track_labels).flat(), dtype=np.int64)
+
+    used = hits["valid"] & np.isin(hits["plane"], station_planes(geometry, stations)) & (labels >= 0)
+
+    # one group per (event, label) pair that has hits
+    num_labels = int(labels[used].max()) + 1 if used.any() else 1
+    keys, group = np.unique(event_index[used] * num_labels + labels[used], return_inverse=True)
+    hit_group = np.full(len(event_index), -1, dtype=np.int64)
+    hit_group[used] = group
+
+    weight = np.zeros(len(event_index))
+    weight[used] = 12 / hits["spacing"][used] ** 2
+
+    fit = fit_lines(hits["position"], hits["z"], hits["cos"], hits["sin"], weight, hit_group, len(keys))
+    fit["event"] = keys // num_labels
+    fit["label"] = keys % num_labels
+    fit["group"] = hit_group
+    return fit
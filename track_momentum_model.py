@@ -1,17 +1,20 @@
-import uproot
 import numpy as np
 import tensorflow as tf
-from scipy.sparse import csr_matrix
 import matplotlib.pyplot as plt
 import os
 from sklearn.preprocessing import StandardScaler
+from concurrent.futures import ThreadPoolExecutor
+from ingest import ingest_files, merge_columns
+from hit_encoding import convert_to_hit_matrices
+from clustering import encode_hits
+from ragged import as_ragged
+from labels import MUON_MASS, build_track_labels
 
 # ------------------------------- #
 #   GLOBAL SETTINGS & CONSTANTS   #
 # ------------------------------- #
 
-# Define a constant for the muon mass in GeV (approx 0.10566 GeV).
-MUON_MASS = 0.10566  
+# The muon mass in GeV (approx 0.10566 GeV) is defined in labels.MUON_MASS.
 
 # List of ROOT files to read in. Each file contains track QA information.
 FILE_PATH = [
@@ -34,6 +37,18 @@ MAX_IDS = 100
 # Directory where plots will be saved.
 PLOTS_DIR = "residual_plots"
 
+# Number of processes used to decode ROOT files (None uses all cores).
+INGEST_WORKERS = None
+
+# Number of events encoded into hit images and scored per model call during inference.
+# The CNN's activations take about 2 MB per event (most of it the first convolution's
+# 98 x 98 x 32 output), so 256 events keep a call to about half a GB.
+INFERENCE_BATCH_SIZE = 256
+
+# Merge hits on neighbouring wires into clusters before building hit images. The CNN must
+# be trained and run on the same encoding, so training and prediction both use this.
+CLUSTER_HITS = False
+
 
 # ----------------------------- #
 #         DATA LOADING          #
@@ -41,37 +56,19 @@ PLOTS_DIR = "residual_plots"
 
 def load_data(file_paths):
     """
-    Loads and merges data from multiple ROOT files using uproot.
+    Loads and merges data from multiple ROOT files, decoding the files in parallel.
     
     Args:
         file_paths (list of str): Paths to the ROOT files containing the data.
 
     Returns:
         dict: A dictionary with keys: 'detectorID', 'elementID', 'gpx', 'gpy', 'gpz', 'n_tracks'.
-              Each entry in the dict is a 1D NumPy array concatenated across all input files.
+              Hit and momentum entries are RaggedArrays and 'n_tracks' is a 1D NumPy array,
+              each concatenated across all input files.
     """
-    # These are the branch names to extract from each ROOT file.
-    branches = ["detectorID", "elementID", "gpx", "gpy", "gpz", "n_tracks"]
-    
-    # Prepare a dictionary to store the data arrays from each file. 
-    # We store them in lists first, then we'll concatenate them at the end.
-    all_data = {key: [] for key in branches}
-
-    # Loop over each file in file_paths
-    for file_path in file_paths:
-        print(f"Loading data from: {file_path}")
-        # Open the ROOT file using uproot
-        with uproot.open(file_path) as file:
-            # Access the tree named "QA_ana"
-            tree = file["QA_ana"]
-            # Extract the branches specified in 'branches'
-            data = tree.arrays(branches, library="np")
-            # Append each branch's data to our all_data dictionary
-            for key in branches:
-                all_data[key].append(data[key])
-
-    # Concatenate all the arrays for each branch to form one large array
-    merged_data = {key: np.concatenate(all_data[key]) for key in branches}
+    # Decode the files in parallel (through the on-disk event cache) and join them in file order
+    print(f"Loading data from {len(file_paths)} files...")
+    merged_data = merge_columns(ingest_files(file_paths, max_workers=INGEST_WORKERS))
     
     return merged_data
 
@@ -127,11 +124,32 @@ def build_track_segmentation_model(input_shape):
     return model
 
 
-def predict_trackwise_data(detector_ids, element_ids, n_tracks, max_ids, model):
+def build_track_hit_images(detector_ids, element_ids, max_ids, cluster=CLUSTER_HITS):
+    """
+    Builds the (max_ids x max_ids) hit images for many events in one vectorized step.
+    
+    Args:
+        detector_ids (array-like): Per-event detector IDs (RaggedArray, object array of 
+                                   arrays, or a padded 2D array).
+        element_ids (array-like):  Per-event element IDs in the same layout.
+        max_ids (int):             Maximum ID value for both detectors and elements (100).
+        cluster (bool):            Keep one hit per cluster of neighbouring wires.
+    
+    Returns:
+        np.ndarray: A float32 array of shape (num_events, max_ids, max_ids, 1) with 1 where 
+                    a (detectorID, elementID) pair was hit. IDs outside [1..max_ids] are ignored.
+    """
+    detector_ids, element_ids = encode_hits(detector_ids, element_ids, cluster)
+    hit_matrices = convert_to_hit_matrices(detector_ids, element_ids, max_ids, max_ids, dtype=np.float32)
+    return hit_matrices[..., np.newaxis]
+
+
+def predict_trackwise_data(detector_ids, element_ids, n_tracks, max_ids, model, batch_size=INFERENCE_BATCH_SIZE, overlap=True, cluster=CLUSTER_HITS):
     """
     Uses a trained CNN model to predict the track ID distribution for each event.
-    This function creates a sparse hit map (max_ids x max_ids) for each event, 
-    runs it through the model, and collects the probabilities.
+    Hit images are built for a whole batch of events at once and the model is run on 
+    each batch in a single call. With overlap=True, a background thread builds the 
+    next batch of images while the model is scoring the current one.
     
     Args:
         detector_ids (array-like): List/array of arrays, each sub-array containing 
@@ -143,35 +161,42 @@ def predict_trackwise_data(detector_ids, element_ids, n_tracks, max_ids, model):
         max_ids (int):             Maximum ID value for both detectors and elements (100).
         model (tf.keras.Model):    The trained CNN model that outputs track assignment 
                                    probabilities.
+        batch_size (int):          Number of events encoded and scored per model call.
+        overlap (bool):            Encode the next batch in a thread while predicting.
+        cluster (bool):            Cluster hits as when the model was trained.
     
     Returns:
         np.ndarray: A 2D numpy array of shape (num_events, 100), where each row is 
                     the probability distribution over the 100 track IDs.
     """
-    track_hit_matrices = []
+    detector_ids = as_ragged(detector_ids)
+    element_ids = as_ragged(element_ids)
     num_events = len(detector_ids)
+    batch_starts = range(0, num_events, batch_size)
 
-    # Loop over each event
-    for evt_index in range(num_events):
-        # Create a sparse matrix of shape (max_ids, max_ids). 
-        # We'll fill in '1' if a given (detectorID, elementID) is hit.
-        mat = csr_matrix((max_ids, max_ids), dtype=np.float32)
-        for d, e in zip(detector_ids[evt_index], element_ids[evt_index]):
-            # Only fill if IDs are within [1..max_ids]
-            if 0 < d <= max_ids and 0 < e <= max_ids:
-                mat[d - 1, e - 1] = 1
-
-        # Reshape the (max_ids x max_ids) array to (1, max_ids, max_ids, 1) for CNN input
-        input_data = mat.toarray().reshape(1, max_ids, max_ids, 1)
-        
-        # Model predicts a distribution of shape (1, 100). 
-        # We take [0] to get the 1D distribution of shape (100,).
-        predicted_tracks = model.predict(input_data)[0]
-        
-        track_hit_matrices.append(predicted_tracks)
+    def encode(start):
+        stop = min(start + batch_size, num_events)
+        return build_track_hit_images(detector_ids[start:stop], element_ids[start:stop], max_ids, cluster)
 
-    # Convert list of predictions to a NumPy array of shape (num_events, 100)
-    return np.array(track_hit_matrices, dtype=np.float32)
+    predictions = []
+    if overlap and len(batch_starts) > 1:
+        # keep one batch being encoded ahead of the batch being scored
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_images = executor.submit(encode, batch_starts[0])
+            for i in range(len(batch_starts)):
+                images = next_images.result()
+                if i + 1 < len(batch_starts):
+                    next_images = executor.submit(encode, batch_starts[i + 1])
+                predictions.append(np.asarray(model.predict_on_batch(images)))
+    else:
+        for start in batch_starts:
+            predictions.append(np.asarray(model.predict_on_batch(encode(start))))
+
+    if len(predictions) == 0:
+        return np.zeros((0, model.output_shape[-1]), dtype=np.float32)
+
+    # Stack the batch predictions into a NumPy array of shape (num_events, 100)
+    return np.concatenate(predictions).astype(np.float32)
 
 
 # ----------------------------- #
@@ -306,19 +331,7 @@ def main():
 
     # Step 2: Construct track 'hit maps'
     print("Preparing track hit matrices...")
-    track_hit_list = []
-    num_events = len(detector_ids)
-    for evt_index in range(num_events):
-        # Create a sparse matrix to fill with hits
-        mat = csr_matrix((MAX_IDS, MAX_IDS), dtype=np.float32)
-        for d, e in zip(detector_ids[evt_index], element_ids[evt_index]):
-            if 0 < d <= MAX_IDS and 0 < e <= MAX_IDS:
-                mat[d - 1, e - 1] = 1
-        # Convert to a dense array and store
-        track_hit_list.append(mat.toarray())
-
-    # Reshape into (num_events, MAX_IDS, MAX_IDS, 1) for CNN input
-    track_hit_matrices = np.array(track_hit_list).reshape(num_events, MAX_IDS, MAX_IDS, 1)
+    track_hit_matrices = build_track_hit_images(detector_ids, element_ids, MAX_IDS, CLUSTER_HITS)
 
     # Step 3: Build & train the CNN for track segmentation
     print("Building and training CNN model for track segmentation...")
@@ -341,7 +354,7 @@ def main():
 
     # Predict track assignments on the entire dataset
     print("Predicting track assignments...")
-    track_predictions = predict_trackwise_data(detector_ids, element_ids, n_tracks, MAX_IDS, cnn_model)
+    track_predictions = predict_trackwise_data(detector_ids, element_ids, n_tracks, MAX_IDS, cnn_model, cluster=CLUSTER_HITS)
 
     # Plot and save track assignment histogram
     plot_track_assignments(track_predictions, PLOTS_DIR)
@@ -350,16 +363,12 @@ def main():
     # Step 4: Build & train a momentum model using the first track's true momentum
     print("Extracting true momenta (px, py, pz, E)...")
     # We assume the first element in gpx, gpy, gpz arrays correspond to the primary track of interest.
-    px = np.array([evt[0] for evt in data['gpx']])
-    py = np.array([evt[0] for evt in data['gpy']])
-    pz = np.array([evt[0] for evt in data['gpz']])
-
-    # Compute energy from momentum and known muon mass
-    # E^2 = p^2 + m^2
-    E  = np.sqrt(px**2 + py**2 + pz**2 + MUON_MASS**2)
+    # build_track_labels computes E^2 = p^2 + m^2 from the known muon mass and returns a mask
+    # of which events actually have a first track.
+    labels, mask = build_track_labels(data['gpx'], data['gpy'], data['gpz'], max_tracks=1, with_energy=True, mass=MUON_MASS)
 
-    # Combine [px, py, pz, E] into a single 2D array of shape (N, 4)
-    y_true = np.vstack([px, py, pz, E]).T
+    # Keep [px, py, pz, E] of the first track as a single 2D array of shape (N, 4)
+    y_true = labels[mask[:, 0], 0, :]
 
     # For demonstration, we'll feed the actual [px,py,pz,E] to the model 
     # (i.e., learning the identity mapping).
@@ -1,41 +1,248 @@
-import sys
+import argparse
 import os
+import queue
+import threading
+import time
+import uproot
+from concurrent.futures import ProcessPoolExecutor
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-from file_read import is_file_still_writing
+from watchdog.events import FileSystemEventHandler, FileClosedEvent
+from file_read import is_root_file_complete, resolve_schema
+from event_cache import CACHE_DIR, HIT_BRANCHES, cache_path, prune_cache, update_cache_index
+from ingest import _convert_file
+
+# CONSTANTS
+ROOT_EXTENSION = ".root"
+STABLE_SECONDS = 2.0  # how long a file's size must stay unchanged before it's checked
+CHECK_INTERVAL = 0.5  # seconds between checks of the files still being written
+INGEST_WORKERS = None  # None uses one worker process per CPU
+
+# Converts ROOT files into the event cache as they finish writing. Watchdog handlers only
+# record that a file changed and return immediately; a checker thread decides when a file
+# is complete (it was closed after writing, or its size has been stable for stable_seconds,
+# and its ROOT header/footer are readable) and puts it on a queue. A dispatcher thread drains
+# the queue into a pool of worker processes, and each converted file is added to the cache index.
+class IngestService:
+    def __init__(self, cache_dir=CACHE_DIR, max_workers=INGEST_WORKERS, stable_seconds=STABLE_SECONDS,
+                 check_interval=CHECK_INTERVAL, tree_name=None, on_converted=None):
+        self.cache_dir = cache_dir
+        self.on_converted = on_converted  # called with (file_path, cache directory) once indexed
+        self.stable_seconds = stable_seconds
+        self.check_interval = check_interval
+        self.tree_name = tree_name
+        self.max_workers = max_workers or os.cpu_count()
+
+        # path -> [size, time the size last changed, closed since last check]
+        self._pending = dict()
+        self._pending_lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self.queue = queue.Queue()
+
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        self._checker = threading.Thread(target=self._check_pending, daemon=True)
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._checker.start()
+        self._dispatcher.start()
+
+    # A file was created or written to; it is checked again once its size settles
+    def file_changed(self, file_path):
+        if not file_path.endswith(ROOT_EXTENSION):
+            return
+
+        with self._pending_lock:
+            if file_path not in self._pending:
+                self._pending[file_path] = [-1, time.time(), False]
+
+    # A file that was open for writing was closed; check it right away
+    def file_closed(self, file_path):
+        if not file_path.endswith(ROOT_EXTENSION):
+            return
+
+        with self._pending_lock:
+            self._pending.setdefault(file_path, [-1, time.time(), False])[2] = True
+        self._wakeup.set()
+
+    # Queue the ROOT files already under path (files with an up to date cache are skipped)
+    def scan(self, path):
+        for directory, _, file_names in os.walk(path):
+            for file_name in file_names:
+                self.file_changed(os.path.join(directory, file_name))
+
+    def _check_pending(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.check_interval)
+            self._wakeup.clear()
+
+            now = time.time()
+            with self._pending_lock:
+                candidates = list(self._pending.items())
+
+            for file_path, (size, changed_time, closed) in candidates:
+                try:
+                    new_size = os.path.getsize(file_path)
+                except OSError:
+                    # deleted or renamed before it was finished
+                    with self._pending_lock:
+                        self._pending.pop(file_path, None)
+                    continue
+
+                with self._pending_lock:
+                    if new_size != size:
+                        self._pending[file_path] = [new_size, now, False]
+                        if not closed:
+                            continue
+                    elif not closed and now - changed_time < self.stable_seconds:
+                        continue
+                    self._pending[file_path][2] = False
+
+                # closed or stable: the file is done once ROOT's header and keys are readable
+                if is_root_file_complete(file_path):
+                    with self._pending_lock:
+                        self._pending.pop(file_path, None)
+                    self.queue.put(file_path)
+                else:
+                    # unreadable for now: try again after another stable period
+                    with self._pending_lock:
+                        if file_path in self._pending:
+                            self._pending[file_path][1] = now
+
+    def _dispatch(self):
+        while True:
+            file_path = self.queue.get()
+            if file_path is None:
+                break
+
+            try:
+                if os.path.exists(os.path.join(cache_path(file_path, self.cache_dir), "meta.json")):
+                    self._converted(file_path, cache_path(file_path, self.cache_dir))
+                    continue
+
+                # resolve the tree and branches here so worker processes never have to prompt;
+                # nobody can answer a prompt from this thread, so an ambiguous new layout is skipped
+                tree_name, branch_names = self.tree_name, None
+                if tree_name is None:
+                    with uproot.open(file_path) as file:
+                        tree_name, branch_names = resolve_schema(file, HIT_BRANCHES, interactive=False)
+            except Exception as error:
+                print("Skipping {}: {}".format(file_path, error))
+                continue
+
+            print("Converting {} ({} queued)".format(file_path, self.queue.qsize()))
+            future = self._executor.submit(_convert_file, file_path, self.cache_dir, tree_name, branch_names)
+            future.add_done_callback(lambda future, file_path=file_path: self._finished(file_path, future))
+
+    def _finished(self, file_path, future):
+        try:
+            directory = future.result()
+        except Exception as error:
+            print("Failed to convert {}: {}".format(file_path, error))
+            return
+
+        self._converted(file_path, directory)
+
+    def _converted(self, file_path, directory):
+        with self._index_lock:
+            index = update_cache_index(file_path, directory, self.cache_dir)
+        print("Indexed {} -> {} ({} events)".format(file_path, directory, index[os.path.abspath(file_path)]["num_events"]))
+
+        if self.on_converted is not None:
+            self.on_converted(file_path, directory)
+
+    # Remove stale cache directories and their index entries, in step with the index updates
+    def prune(self):
+        with self._index_lock:
+            removed = prune_cache(self.cache_dir)
+        for directory in removed:
+            print("Pruned {}".format(directory))
+
+    # Stop checking for new files, finish the conversions that were already queued
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        self._checker.join()
+        self.queue.put(None)
+        self._dispatcher.join()
+        self._executor.shutdown(wait=True)
 
 class Handler(FileSystemEventHandler):
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+
     def on_any_event(self, event):
-        # Process created files/directories
-        if event.event_type == 'created':
-            created_path = event.src_path
-            
-            # check if path is directory
-            if (os.path.isdir(created_path)):
-                print("Created new directory: " + created_path)
-            else:
-                print("Created new file: " + created_path)
-
-                # check if file is file is done uploading
-                print("Checking if file is closed...")
-                while is_file_still_writing(created_path, 0.1):
-                    print("File still writing...")
-                print("File is closed!")
+        # report created directories, hand every file event to the ingest service
+        if event.is_directory:
+            if event.event_type == 'created':
+                print("Created new directory: " + event.src_path)
+            return
+
+        if isinstance(event, FileClosedEvent):
+            self.service.file_closed(event.src_path)
+        elif event.event_type in ('created', 'modified'):
+            self.service.file_changed(event.src_path)
+        elif event.event_type == 'moved':
+            # files copied in under a temporary name and renamed once complete
+            self.service.file_closed(event.dest_path)
+
+# Keeps track of the most recently created or written ROOT file under a watched directory
+class NewestFileHandler(FileSystemEventHandler):
+    def __init__(self, path):
+        super().__init__()
+        self.newest = newest_root_file(path)
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+
+        file_path = event.dest_path if event.event_type == 'moved' else event.src_path
+        if file_path.endswith(ROOT_EXTENSION) and event.event_type in ('created', 'modified', 'closed', 'moved'):
+            self.newest = file_path
+
+# Most recently modified ROOT file under path, or None if there are none
+def newest_root_file(path):
+    newest, newest_time = None, None
+    for directory, _, file_names in os.walk(path):
+        for file_name in file_names:
+            if not file_name.endswith(ROOT_EXTENSION):
+                continue
+            file_path = os.path.join(directory, file_name)
+            modified_time = os.path.getmtime(file_path)
+            if newest_time is None or modified_time > newest_time:
+                newest, newest_time = file_path, modified_time
+
+    return newest
 
 if __name__ == "__main__":
-    # choose path to watch
-    path = sys.argv[1] if len(sys.argv) > 1 else '.'
+    # choose path to watch and how to ingest
+    parser = argparse.ArgumentParser(description="Convert ROOT files into the event cache as they arrive")
+    parser.add_argument("path", nargs="?", default=".", help="directory to watch")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="conversion worker processes (default: one per CPU)")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="event cache directory")
+    parser.add_argument("--stable-seconds", type=float, default=STABLE_SECONDS, help="seconds a file's size must stay unchanged")
+    parser.add_argument("--tree", help="tree holding the hits (detected automatically if omitted)")
+    parser.add_argument("--existing", action="store_true", help="also ingest ROOT files already in the directory")
+    parser.add_argument("--prune", action="store_true", help="first remove caches of modified or deleted files")
+    args = parser.parse_args()
+
+    service = IngestService(args.cache_dir, args.workers, args.stable_seconds, tree_name=args.tree)
+    if args.prune:
+        service.prune()
+    if args.existing:
+        service.scan(args.path)
 
     # event handler
-    event_handler = Handler()
+    event_handler = Handler(service)
     observer = Observer()
-    observer.schedule(event_handler, path, recursive=True)
+    observer.schedule(event_handler, args.path, recursive=True)
     observer.start()
 
     # main loop
-    try:    
+    try:
         while observer.is_alive():
             observer.join(1)
-    finally:    
+    finally:
         observer.stop()
-        observer.join()
\ No newline at end of file
+        observer.join()
+        service.stop()